@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# fakelandiallerd.py - a stand-in for the landialler server
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""a stand-in for landiallerd, for testing the client without a modem
+
+fakelandiallerd implements the same XML-RPC interface as the real
+server (connect, disconnect and get_status) but pretends to dial
+rather than driving a modem. It also implements wait_for_status, the
+long poll that clients use to be told about changes as they happen,
+and system.multicall. The status can also be fetched without XML-RPC,
+as a compact binary frame, with "GET /status/<client_id>"; this can be
+turned off to test clients against an older server.
+
+To make it behave like a server on a slow or unreliable network it
+can delay every reply (by latency seconds, plus a random amount of up
+to jitter seconds), and fail a proportion of calls with a fault.
+
+Usage: fakelandiallerd.py [options]
+
+  -p port, --port=port          port to listen on (default 6543)
+  -d secs, --dial-time=secs     time taken to "dial" (default 5)
+  -l secs, --latency=secs       delay before each reply (default 0)
+  -j secs, --jitter=secs        maximum extra random delay (default 0)
+  -f rate, --failure-rate=rate  proportion of calls to fail (default 0)
+  --no-status-frame             answer GET requests like older servers
+
+"""
+
+
+import optparse
+import random
+import SimpleXMLRPCServer
+import SocketServer
+import struct
+import threading
+import time
+import urllib
+import xmlrpclib
+
+
+class FakeModem(object):
+
+    """Keeps track of clients and a pretend dial up connection.
+
+    Each change to the number of users or to the connection state
+    increments version, which wait_for_status() uses to decide whether
+    a client's idea of the status is out of date.
+
+    """
+
+    def __init__(self, dial_time=5):
+        self.dial_time = dial_time
+        self.version = 1
+        self._clients = {}
+        self._connected_at = None
+        self._dialler = None
+        self._changed = threading.Condition()
+
+    def _status(self):
+        if self._connected_at is None:
+            return (len(self._clients), False, 0)
+        seconds_online = int(time.time() - self._connected_at)
+        return (len(self._clients), True, seconds_online)
+
+    def _notify_change(self):
+        self.version += 1
+        self._changed.notifyAll()
+
+    def _dialled(self):
+        self._changed.acquire()
+        try:
+            if self._clients and self._connected_at is None:
+                self._connected_at = time.time()
+                self._notify_change()
+        finally:
+            self._changed.release()
+
+    def connect(self, client_id):
+        self._changed.acquire()
+        try:
+            if client_id not in self._clients:
+                self._clients[client_id] = None
+                self._notify_change()
+            if self._connected_at is None and self._dialler is None:
+                self._dialler = threading.Timer(self.dial_time, self._dialled)
+                self._dialler.setDaemon(True)
+                self._dialler.start()
+        finally:
+            self._changed.release()
+        return True
+
+    def disconnect(self, client_id, all=False):
+        self._changed.acquire()
+        try:
+            if client_id in self._clients:
+                del self._clients[client_id]
+            if all:
+                self._clients.clear()
+            if not self._clients:
+                if self._dialler is not None:
+                    self._dialler.cancel()
+                    self._dialler = None
+                self._connected_at = None
+            self._notify_change()
+        finally:
+            self._changed.release()
+        return True
+
+    def get_status(self, client_id):
+        self._changed.acquire()
+        try:
+            return self._status()
+        finally:
+            self._changed.release()
+
+    def wait_for_status(self, client_id, version, timeout):
+        """Return (version, ) + status once version is out of date."""
+        self._changed.acquire()
+        try:
+            deadline = time.time() + timeout
+            while self.version == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return (self.version, ) + self._status()
+        finally:
+            self._changed.release()
+
+
+# The layout of the binary status frame: number of users, connected
+# flag and seconds on-line, in network byte order (the same as
+# landialler.CompactStatusProxy.STATUS_FRAME).
+STATUS_FRAME = "!HBI"
+
+
+class RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # allow clients to keep connections open
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if not self.server.status_frames:
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+            return
+        if not self.path.startswith("/status/"):
+            self.send_error(404)
+            return
+        if not self.server.inject_delay():
+            self.send_error(500, "injected failure")
+            return
+        client_id = urllib.unquote(self.path[len("/status/"):])
+        body = struct.pack(STATUS_FRAME,
+                           *self.server.modem.get_status(client_id))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn,
+             SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    """Serves a FakeModem over XML-RPC, one thread per connection."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, modem=None, latency=0, jitter=0,
+                 failure_rate=0, status_frames=True):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, address, RequestHandler, logRequests=False)
+        if modem is None:
+            modem = FakeModem()
+        self.modem = modem
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.status_frames = status_frames
+        self.register_introspection_functions()
+        self.register_multicall_functions()
+        self.register_function(modem.connect, "connect")
+        self.register_function(modem.disconnect, "disconnect")
+        self.register_function(modem.get_status, "get_status")
+        self.register_function(modem.wait_for_status, "wait_for_status")
+
+    def inject_delay(self):
+        """Delay a reply, returning False if it should fail instead."""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return random.random() >= self.failure_rate
+
+    def _marshaled_dispatch(self, data, *args):
+        if not self.inject_delay():
+            return xmlrpclib.dumps(xmlrpclib.Fault(1, "injected failure"),
+                                   methodresponse=1)
+        return SimpleXMLRPCServer.SimpleXMLRPCServer._marshaled_dispatch(
+            self, data, *args)
+
+    def start(self):
+        """Serve requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-p", "--port", type="int", default=6543,
+                      help="port to listen on")
+    parser.add_option("-d", "--dial-time", type="float", default=5,
+                      help="seconds taken to connect")
+    parser.add_option("-l", "--latency", type="float", default=0,
+                      help="seconds to wait before each reply")
+    parser.add_option("-j", "--jitter", type="float", default=0,
+                      help="maximum extra random delay, in seconds")
+    parser.add_option("-f", "--failure-rate", type="float", default=0,
+                      help="proportion of calls that fail")
+    parser.add_option("--no-status-frame", action="store_false",
+                      dest="status_frames", default=True,
+                      help="don't serve binary status frames")
+    options, args = parser.parse_args()
+    server = Server(("", options.port), FakeModem(options.dial_time),
+                    options.latency, options.jitter, options.failure_rate,
+                    options.status_frames)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
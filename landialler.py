@@ -54,6 +54,25 @@ sample configuration file looks like this:
   hostname: 192.168.1.1  # your Unix box
   port: 7293             # the default port
 
+The hostname can also be a comma separated list of servers, in which
+case the client uses whichever of them responds first.
+
+An optional [polling] section controls how often the client asks the
+server for its status, and a [sharing] section lets all the clients
+running on one machine share a single view of the status (see the
+sample landialler.conf for details).
+
+LANdialler can also be controlled from the command line (e.g. from
+scripts or cron jobs), in which case no windows are shown:
+
+  landialler.py --status           print the status
+  landialler.py --connect --wait   connect, and wait until on-line
+  landialler.py --disconnect       disconnect (--all for everybody)
+  landialler.py --watch            print the status as it changes
+
+--status exits with 0 if the server is connected and 1 if it isn't;
+all commands exit with 2 if the server can't be contacted.
+
 The configuration file should be called "landialler.conf". On POSIX
 operating systems (e.g. Unix or similar) it can either be placed in
 /usr/local/etc, or the current directory. On other operating systems
@@ -71,83 +90,2157 @@ The author can be contacted at ashtong@users.sourceforge.net.
 __version__ = "0.3.0"
 
 
+import time
+
+_IMPORTS_STARTED = time.time()  # for --profile-startup
+
+import bisect
 import ConfigParser
+import errno
+import httplib
+import math
+import optparse
 import os
+import Queue
+import random
 import socket
+import stat
+import struct
 import sys
-import time
-import traceback
+import threading
+import weakref
 import xmlrpclib
 
-import pygtk; pygtk.require("2.0")
-import gobject
-import gtk
-import gtk.glade
+gobject = None
+gtk = None
+
+
+def import_gtk():
+    """Import the GTK modules, which only the graphical client needs.
+
+    They're slow to import and need a display, so the command line
+    interface manages without them.
+
+    """
+    global gobject, gtk
+    if gtk is None:
+        import pygtk
+        pygtk.require("2.0")
+        import gobject
+        import gtk
+        import gtk.glade
+
+
+def _accepts_changes(observer):
+    try:
+        code = observer.update.im_func.func_code
+    except AttributeError:
+        return False
+    return code.co_argcount > 1
 
 
 class Observable(object):
 
+    """Tells its observers when it changes, by calling update().
+
+    If an observer's update() method takes an argument it's passed a
+    dict whose keys are the names of the attributes that changed.
+    Observers are only weakly referenced, so an observer that is
+    thrown away without being removed stops being notified.
+
+    """
+
     def __init__(self):
-        self._observers = {}
+        self._observers = {}  # id -> (weak reference, accepts changes)
 
     def add_observer(self, observer):
-        self._observers[observer] = None
+        self._observers[id(observer)] = (weakref.ref(observer),
+                                         _accepts_changes(observer))
 
     def remove_observer(self, observer):
-        del self._observers[observer]
+        del self._observers[id(observer)]
+
+    def notify_observers(self, changes=None):
+        if changes is None:
+            changes = {}
+        for key, (ref, accepts_changes) in self._observers.items():
+            observer = ref()
+            if observer is None:  # thrown away without being removed
+                del self._observers[key]
+            elif accepts_changes:
+                observer.update(changes)
+            else:
+                observer.update()
 
-    def notify_observers(self):
-        for observer in self._observers.keys():
-            observer.update()
+
+def _call_once(func, *args):
+    func(*args)
+    return False  # don't let idle_add call us again
+
+
+class RpcCall(object):
+
+    """A call queued on an RpcWorker.
+
+    Cancelling a call that hasn't been made yet stops it being made.
+    If the call is already in progress it is allowed to finish (or
+    time out), but its result is thrown away.
+
+    """
+
+    def __init__(self, func, args, callback, errback):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.cancelled = False
+        self.started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Mark the call as started, unless it has been cancelled."""
+        self._lock.acquire()
+        try:
+            if not self.cancelled:
+                self.started = True
+            return self.started
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        """Cancel the call, returning True if it will never be made."""
+        self._lock.acquire()
+        try:
+            self.cancelled = True
+            return not self.started
+        finally:
+            self._lock.release()
+
+
+class RpcWorker(object):
+
+    """Makes remote procedure calls on a background thread.
+
+    Calls are made in the order that they are queued. The result of
+    each call is handed back to the main thread by the dispatch
+    function (e.g. gobject.idle_add), so callbacks never run on the
+    worker thread.
+
+    """
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._requests = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def call(self, func, args, callback, errback):
+        """Queue a call, returning a RpcCall that can be cancelled."""
+        call = RpcCall(func, args, callback, errback)
+        self._requests.put(call)
+        return call
+
+    def stop(self, timeout=None):
+        self._requests.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            call = self._requests.get()
+            if call is None:
+                break
+            if not call.start():
+                continue
+            try:
+                result = call.func(*call.args)
+            except:
+                if not call.cancelled:
+                    self._dispatch(_call_once, call.errback, sys.exc_info())
+            else:
+                if not call.cancelled:
+                    self._dispatch(_call_once, call.callback, result)
+
+
+class KeepAliveTransport(xmlrpclib.Transport):
+
+    """An XML-RPC transport that keeps its HTTP connection open.
+
+    The standard transport opens a new TCP connection for every call.
+    This one makes HTTP/1.1 requests and reuses the connection for as
+    long as the server is willing to keep it open, transparently
+    reconnecting if the server has closed it since the last call. A
+    request is only sent again if the connection turns out to have
+    been closed; if the server is just slow to reply (or times out) it
+    may already be acting on the request.
+
+    The connections_opened and calls_made attributes record how well
+    the connection is being reused, and bytes_sent and bytes_received
+    count the bytes in the request and response bodies.
+
+    If timeout is set, a call that gets no response from the server
+    for timeout seconds fails with socket.timeout. If an AddressCache
+    is given the server's address is looked up in it, rather than
+    every time a connection is opened.
+
+    """
+
+    def __init__(self, timeout=None, addresses=None):
+        self.timeout = timeout
+        self._addresses = addresses
+        self._connection = None
+        self._host = None
+        self.connections_opened = 0
+        self.calls_made = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def _get_connection(self, host):
+        if self._connection is None or host != self._host:
+            self.close()
+            if self._addresses is None:
+                connection = httplib.HTTPConnection(host)
+                if self.timeout is not None:
+                    connection.timeout = self.timeout  # used by Python 2.6+
+                connection.connect()
+                connection.sock.settimeout(self.timeout)
+            else:
+                connection = httplib.HTTPConnection(host)
+                connection.sock = _connect_socket(
+                    self._addresses.resolve(host), self.timeout)
+            self._connection = connection
+            self._host = host
+            self.connections_opened += 1
+        return self._connection
+
+    def adopt(self, host, sock):
+        """Use sock (already connected to host) for the next call."""
+        self.close()
+        sock.settimeout(self.timeout)
+        self._connection = httplib.HTTPConnection(host)
+        self._connection.sock = sock
+        self._host = host
+        self.connections_opened += 1
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _send(self, method, host, handler, body, headers):
+        connection = self._get_connection(host)
+        connection.request(method, handler, body, headers)
+        try:
+            return connection.getresponse(buffering=True)
+        except TypeError:  # httplib before Python 2.7 doesn't buffer
+            return connection.getresponse()
+
+    # errors that mean the server had closed the connection
+    CLOSED_ERRNOS = [errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED]
+
+    def _was_closed(self, exc):
+        if isinstance(exc, httplib.BadStatusLine):
+            return True
+        if isinstance(exc, socket.timeout) or \
+               not isinstance(exc, socket.error):
+            return False
+        return len(exc.args) > 1 and exc.args[0] in self.CLOSED_ERRNOS
+
+    def _exchange(self, method, host, handler, body, headers):
+        self.calls_made += 1
+        reusing = self._connection is not None and host == self._host
+        try:
+            response = self._send(method, host, handler, body, headers)
+        except (socket.error, httplib.HTTPException), e:
+            self.close()
+            if not (reusing and self._was_closed(e)):
+                raise
+            response = self._send(method, host, handler, body, headers)
+        try:
+            data = response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()  # the rest of the response may still arrive
+            raise
+        if body is not None:
+            self.bytes_sent += len(body)
+        self.bytes_received += len(data)
+        if response.will_close:
+            self.close()
+        return response, data
+
+    def get(self, host, path):
+        """Make a GET request.
+
+        Returns the HTTP status, the content type and the body.
+
+        """
+        response, data = self._exchange("GET", host, path, None,
+                                        {"User-Agent": self.user_agent})
+        return response.status, response.getheader("Content-Type"), data
+
+    def request(self, host, handler, request_body, verbose=0):
+        response, data = self._exchange("POST", host, handler, request_body,
+                                        {"Content-Type": "text/xml",
+                                         "User-Agent": self.user_agent})
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                          response.reason, response.msg)
+        parser, unmarshaller = xmlrpclib.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+
+class CompactStatusProxy(object):
+
+    """A server proxy that gets the status in a compact binary frame.
+
+    XML-RPC is a verbose way of sending three numbers. Servers that
+    support it answer "GET /status/<client_id>" with the status packed
+    as STATUS_FRAME (the number of users, whether the server is
+    connected, and the seconds on-line, in network byte order). The
+    first call to get_status() finds out whether the server does so;
+    older servers answer GET requests with 501 Not Implemented, in
+    which case get_status() is called over XML-RPC from then on. The
+    same goes for a reply that isn't a status frame (e.g. a web page
+    from a proxy). All other methods are called over XML-RPC.
+
+    """
+
+    STATUS_FRAME = "!HBI"
+    CONTENT_TYPE = "application/octet-stream"
+    UNSUPPORTED = [400, 404, 405, 501]  # HTTP statuses
+
+    def __init__(self, server_proxy, host, transport):
+        self._server_proxy = server_proxy
+        self._host = host
+        self._transport = transport
+        self.is_supported = None  # don't know until we've asked
+
+    def __getattr__(self, name):
+        return getattr(self._server_proxy, name)
+
+    def get_status(self, client_id):
+        if self.is_supported is not False:
+            import urllib
+            path = "/status/%s" % urllib.quote(client_id)
+            status, content_type, data = self._transport.get(self._host,
+                                                             path)
+            if status == 200 and content_type == self.CONTENT_TYPE and \
+                   len(data) == struct.calcsize(self.STATUS_FRAME):
+                self.is_supported = True
+                num_users, is_connected, seconds_online = \
+                           struct.unpack(self.STATUS_FRAME, data)
+                return (num_users, bool(is_connected), seconds_online)
+            elif status == 200 or status in self.UNSUPPORTED:
+                self.is_supported = False
+            else:
+                raise xmlrpclib.ProtocolError(self._host + path, status,
+                                              "status frame request failed",
+                                              {})
+        return self._server_proxy.get_status(client_id)
+
+
+def _split_host(host, default_port=80):
+    """Split "host:port" (or "[address]:port") into host and port."""
+    if host.startswith("["):
+        address, rest = host[1:].split("]", 1)
+        if rest.startswith(":"):
+            return address, int(rest[1:])
+        return address, default_port
+    if ":" in host:
+        host, port = host.split(":", 1)
+        return host, int(port)
+    return host, default_port
+
+
+def _connect_socket(addresses, timeout=None):
+    """Connect to the first of addresses (from getaddrinfo) that works."""
+    error = socket.error("no addresses to connect to")
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(sockaddr)
+            return sock
+        except socket.error, error:
+            sock.close()
+    raise error
+
+
+class AddressCache(object):
+
+    """Looks up the addresses of servers, remembering them for a while.
+
+    Addresses are kept for ttl seconds. If a name can't be looked up
+    again once it has expired the old addresses are used.
+
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._addresses = {}  # host -> (expiry time, addresses)
+        self.lookups = 0
+
+    def resolve(self, host):
+        """Return getaddrinfo()'s addresses for "host:port"."""
+        self._lock.acquire()
+        try:
+            expires, addresses = self._addresses.get(host, (0, None))
+        finally:
+            self._lock.release()
+        if time.time() < expires:
+            return addresses
+        hostname, port = _split_host(host)
+        try:
+            self.lookups += 1
+            addresses = socket.getaddrinfo(hostname, port, socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM)
+        except socket.error:
+            if addresses is None:
+                raise
+            return addresses
+        self._lock.acquire()
+        try:
+            self._addresses[host] = (time.time() + self.ttl, addresses)
+        finally:
+            self._lock.release()
+        return addresses
+
+    def prefetch(self, hosts):
+        """Look hosts up on a background thread, ready for later."""
+        def resolve_all():
+            for host in hosts:
+                try:
+                    self.resolve(host)
+                except socket.error:
+                    pass
+        thread = threading.Thread(target=resolve_all)
+        thread.setDaemon(True)
+        thread.start()
+
+
+class Endpoint(object):
+
+    """One of the servers that a FailoverServerProxy can call."""
+
+    def __init__(self, host, transport):
+        self.host = host
+        self.transport = transport
+        self.proxy = CompactStatusProxy(
+            xmlrpclib.ServerProxy("http://%s/" % host, transport), host,
+            transport)
+        self.rtt = None  # seconds, smoothed
+
+    def measured(self, seconds):
+        if self.rtt is None:
+            self.rtt = seconds
+        else:
+            self.rtt = 0.8 * self.rtt + 0.2 * seconds
+
+
+class _FailoverMethod(object):
+
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = name
+
+    def __getattr__(self, name):
+        return _FailoverMethod(self._proxy, "%s.%s" % (self._name, name))
+
+    def __call__(self, *args):
+        return self._proxy._call(self._name, args)
+
+
+class FailoverServerProxy(object):
+
+    """Calls several equivalent servers, using whichever one works.
+
+    Before the first call a connection is opened to each server in
+    turn, happy eyeballs style; the next attempt starts after stagger
+    seconds (or as soon as the previous one fails) and the server that
+    answers first is used. If a call to it fails with a network error
+    the other servers are tried, those that have been quickest to
+    respond first, and the one that works is used from then on.
+
+    Only one thread should use a proxy at a time.
+
+    """
+
+    STAGGER = 0.25
+
+    def __init__(self, endpoints, timeout=None, addresses=None):
+        self.endpoints = endpoints
+        self.timeout = timeout
+        if addresses is None:
+            addresses = AddressCache()
+        self._addresses = addresses
+        self.current = None
+        self.failovers = 0
+
+    def __getattr__(self, name):
+        if name.startswith("__"):  # e.g. __repr__; not a remote method
+            raise AttributeError, name
+        return _FailoverMethod(self, name)
+
+    def _attempt(self, endpoint, results):
+        started = time.time()
+        try:
+            sock = _connect_socket(self._addresses.resolve(endpoint.host),
+                                   self.timeout)
+        except socket.error:
+            results.put((endpoint, None))
+        else:
+            endpoint.measured(time.time() - started)
+            results.put((endpoint, sock))
+
+    def _race(self):
+        """Connect to the quickest server, and return it."""
+        results = Queue.Queue()
+        waiting = self.endpoints[:]
+        running = 0
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout + \
+                       self.STAGGER * len(waiting)
+        while waiting or running:
+            if waiting:
+                thread = threading.Thread(target=self._attempt,
+                                          args=(waiting.pop(0), results))
+                thread.setDaemon(True)
+                thread.start()
+                running += 1
+                wait = self.STAGGER
+            elif deadline is None:
+                wait = None
+            else:
+                wait = max(deadline - time.time(), 0)
+            try:
+                endpoint, sock = results.get(True, wait)
+            except Queue.Empty:
+                if waiting:
+                    continue
+                self._close_losers(results, running)
+                break
+            running -= 1
+            if sock is not None:
+                endpoint.transport.adopt(endpoint.host, sock)
+                self._close_losers(results, running)
+                return endpoint
+        raise socket.error("couldn't connect to any server")
+
+    def _close_losers(self, results, running):
+        def close():
+            for i in range(running):
+                endpoint, sock = results.get()
+                if sock is not None:
+                    sock.close()
+        thread = threading.Thread(target=close)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _by_speed(self):
+        def speed(endpoint):
+            if endpoint.rtt is None:
+                return (1, 0)
+            return (0, endpoint.rtt)
+        others = [(speed(endpoint), i, endpoint)
+                  for i, endpoint in enumerate(self.endpoints)
+                  if endpoint is not self.current]
+        others.sort()
+        return [self.current] + [endpoint for key, i, endpoint in others]
+
+    def _call(self, name, args):
+        if self.current is None:
+            self.current = self._race()
+        error = None
+        for endpoint in self._by_speed():
+            started = time.time()
+            try:
+                result = getattr(endpoint.proxy, name)(*args)
+            except (socket.error, httplib.HTTPException,
+                    xmlrpclib.ProtocolError):
+                error = sys.exc_info()
+                endpoint.transport.close()
+                continue
+            endpoint.measured(time.time() - started)
+            if endpoint is not self.current:
+                self.current = endpoint
+                self.failovers += 1
+            return result
+        raise error[0], error[1], error[2]
+
+
+class CallStats(object):
+
+    def __init__(self, num_buckets):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = {}  # kind of error -> count
+        self.histogram = [0] * num_buckets
+
+
+class RpcStats(object):
+
+    """Records how long remote calls take, and how many of them fail.
+
+    Call times are counted in a histogram, whose buckets are bounded
+    by BUCKETS (in milliseconds). Calls can be recorded on any thread.
+
+    """
+
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = {}  # method name -> CallStats
+
+    def _error_kind(self, exc_type):
+        if issubclass(exc_type, socket.timeout):
+            return "timeouts"
+        elif issubclass(exc_type, socket.error):
+            return "socket errors"
+        elif issubclass(exc_type, xmlrpclib.Fault):
+            return "faults"
+        else:
+            return "other errors"
+
+    def record(self, method, seconds, exc_type=None):
+        self._lock.acquire()
+        try:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = CallStats(len(self.BUCKETS) + 1)
+                self.methods[method] = stats
+            stats.calls += 1
+            stats.total_time += seconds
+            stats.max_time = max(stats.max_time, seconds)
+            stats.histogram[bisect.bisect_left(self.BUCKETS,
+                                               seconds * 1000)] += 1
+            if exc_type is not None:
+                kind = self._error_kind(exc_type)
+                stats.errors[kind] = stats.errors.get(kind, 0) + 1
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Return a description of the calls, as a list of lines."""
+        lines = []
+        self._lock.acquire()
+        try:
+            names = self.methods.keys()
+            names.sort()
+            for name in names:
+                stats = self.methods[name]
+                lines.append("%s: %d calls, mean %.1f ms, max %.1f ms" %
+                             (name, stats.calls,
+                              stats.total_time / stats.calls * 1000,
+                              stats.max_time * 1000))
+                if stats.errors:
+                    errors = ["%d %s" % (count, kind)
+                              for kind, count in stats.errors.items()]
+                    lines.append("  errors: " + ", ".join(errors))
+                buckets = []
+                for i in range(len(stats.histogram)):
+                    if stats.histogram[i]:
+                        if i < len(self.BUCKETS):
+                            bound = "<=%d" % self.BUCKETS[i]
+                        else:
+                            bound = ">%d" % self.BUCKETS[-1]
+                        buckets.append("%s: %d" % (bound, stats.histogram[i]))
+                lines.append("  ms " + ", ".join(buckets))
+        finally:
+            self._lock.release()
+        return lines
+
+
+class StatusSubscription(object):
+
+    """Receives status changes from the server as they happen.
+
+    Rather than polling, the subscription makes a long poll; it calls
+    wait_for_status(), which the server doesn't answer until the status
+    changes (or a timeout expires). Each new status is passed to the
+    modem in the main thread by the dispatch function.
+
+    The subscription runs on its own thread, so it needs a server proxy
+    of its own. If the server doesn't support wait_for_status, or stops
+    responding, the modem is told to go back to polling.
+
+    """
+
+    WAIT_TIMEOUT = 60
+    RETRY_PERIOD = 30
+
+    def __init__(self, server_proxy, modem, dispatch):
+        self._server_proxy = server_proxy
+        self._modem = modem
+        self._dispatch = dispatch
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self._modem.client_id, ))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def _is_supported(self):
+        try:
+            methods = self._server_proxy.system.listMethods()
+        except xmlrpclib.Fault:
+            return False
+        return "wait_for_status" in methods
+
+    def _run(self, client_id):
+        while self._running:
+            try:
+                if not self._is_supported():
+                    break
+                version = 0
+                while self._running:
+                    status = self._server_proxy.wait_for_status(
+                        client_id, version, self.WAIT_TIMEOUT)
+                    version = status[0]
+                    self._dispatch(_call_once, self._modem.status_pushed,
+                                   tuple(status[1:]))
+            except (socket.error, xmlrpclib.Error):
+                self._dispatch(_call_once, self._modem.unsubscribed)
+                time.sleep(self.RETRY_PERIOD * random.uniform(0.5, 1.5))
+        self._dispatch(_call_once, self._modem.unsubscribed)
+
+
+class LocalStatusFeed(object):
+
+    """Shares one client's view of the status with others on the host.
+
+    The first client on a machine to start a feed becomes its
+    publisher. It listens on a Unix domain socket and passes each
+    status that it gets from the server on to the other clients, which
+    subscribe to the socket rather than asking the server themselves.
+    The status is only checked as often as the publisher would check
+    it anyway, so the load on the server doesn't grow with the number
+    of users. If the publisher goes away the subscribers go back to
+    polling, and one of them takes over as publisher.
+
+    Anybody who can write to the socket's directory can pretend to be
+    the publisher, so it should only be writable by the users of
+    LANdialler (e.g. a directory in /var/run belonging to their group).
+    The status isn't shared if anybody can write to the directory, or
+    if the socket can't be used (say, if it was left behind by a client
+    that crashed and belongs to somebody else).
+
+    Each client still tells the server when it connects or
+    disconnects, so that the server can keep count of its users. If a
+    StatusSubscription is given it is only started if this client
+    becomes the publisher.
+
+    """
+
+    RETRY_PERIOD = 1
+    MAX_FAILURES = 3  # attempts to publish before giving up
+    # errors that another client starting to publish can cause
+    RETRY_ERRNOS = [errno.EADDRINUSE, errno.EPERM]
+
+    def __init__(self, path, modem, dispatch, subscription=None):
+        self._path = path
+        self._modem = modem
+        self._dispatch = dispatch
+        self._subscription = subscription
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._last_status = None
+        self._publisher = None
+        self._running = False
+        self.is_publishing = False
+
+    def is_supported():
+        return hasattr(socket, "AF_UNIX")
+
+    is_supported = staticmethod(is_supported)
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self._running = False
+        if self.is_publishing:
+            try:
+                os.unlink(self._path)
+            except os.error:
+                pass
+        self._lock.acquire()
+        try:
+            for sock in self._subscribers:
+                sock.close()
+            self._subscribers = []
+        finally:
+            self._lock.release()
+
+    def _get_has_subscribers(self):
+        return len(self._subscribers) > 0
+
+    has_subscribers = property(_get_has_subscribers)
+
+    def publish(self, status):
+        """Send status to the subscribers (if we're the publisher)."""
+        if not self.is_publishing:
+            return
+        num_users, is_connected, seconds_online = status
+        line = "%d %d %d\n" % (num_users, is_connected, seconds_online)
+        self._lock.acquire()
+        try:
+            self._last_status = line
+            for sock in self._subscribers[:]:
+                self._send(sock, line)
+        finally:
+            self._lock.release()
+
+    def _send(self, sock, line):
+        # Called with the lock held. Subscribers' sockets don't block,
+        # so those that can't keep up are dropped (they'll resubscribe)
+        # rather than holding up the publisher.
+        try:
+            sock.sendall(line)
+        except socket.error:
+            self._subscribers.remove(sock)
+            sock.close()
+
+    def _is_secure(self):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        try:
+            return not os.stat(directory).st_mode & stat.S_IWOTH
+        except os.error:
+            return True  # we'll find out when we try to use it
+
+    def _give_up(self, reason):
+        print >> sys.stderr, "landialler: not sharing the status (%s)" % \
+              reason
+        self._running = False
+        if self._subscription is not None:
+            self._subscription.start()
+
+    def _run(self):
+        if not self._is_secure():
+            self._give_up("anybody can write to the directory of %s" %
+                          self._path)
+            return
+        failures = 0
+        while self._running:
+            sock = self._connect()
+            if sock is not None:
+                failures = 0
+                self._receive(sock)
+                self._dispatch(_call_once, self._modem.unsubscribed)
+            else:
+                try:
+                    listener = self._listen()
+                except (socket.error, os.error), e:
+                    failures += 1
+                    if failures >= self.MAX_FAILURES or \
+                           e.args[0] not in self.RETRY_ERRNOS:
+                        self._give_up("can't use %s: %s" % (self._path, e))
+                        break
+                else:
+                    if listener is not None:
+                        self._serve(listener)
+                        break
+            time.sleep(self.RETRY_PERIOD * random.uniform(0.5, 1.5))
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def _listen(self):
+        """Return a socket to publish on.
+
+        Returns None if another client has started publishing, and
+        raises socket.error or os.error if we can't publish.
+
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                listener.bind(self._path)
+            except socket.error, e:
+                if e.args[0] != errno.EADDRINUSE:
+                    raise
+                # Either another client has just started publishing,
+                # or the last publisher didn't clean up after itself.
+                sock = self._connect()
+                if sock is not None:
+                    sock.close()
+                    listener.close()
+                    return None
+                os.unlink(self._path)
+                listener.bind(self._path)
+            os.chmod(self._path, 0666)  # other users need to connect
+            listener.listen(5)
+        except (socket.error, os.error):
+            listener.close()
+            raise
+        return listener
+
+    def _receive(self, sock):
+        self._publisher = sock
+        try:
+            lines = sock.makefile("r")
+            try:
+                for line in iter(lines.readline, ""):
+                    try:
+                        status = self._parse(line)
+                    except ValueError:
+                        continue
+                    self._dispatch(_call_once, self._modem.status_pushed,
+                                   status)
+            except socket.error:
+                pass
+        finally:
+            self._publisher = None
+            sock.close()
+
+    def _parse(self, line):
+        num_users, is_connected, seconds_online = map(int, line.split())
+        return (num_users, bool(is_connected), seconds_online)
+
+    def _serve(self, listener):
+        import select
+        self.is_publishing = True
+        if self._subscription is not None:
+            self._subscription.start()
+        try:
+            while self._running:
+                sockets = [listener] + self._subscribers
+                try:
+                    readable = select.select(sockets, [], [], 1)[0]
+                except (select.error, socket.error):
+                    continue  # a subscriber was dropped while we waited
+                for sock in readable:
+                    if sock is listener:
+                        self._accept(listener)
+                    else:
+                        self._read_request(sock)
+        finally:
+            listener.close()
+
+    def _accept(self, listener):
+        sock = listener.accept()[0]
+        sock.setblocking(0)
+        self._lock.acquire()
+        try:
+            self._subscribers.append(sock)
+            if self._last_status is not None:
+                self._send(sock, self._last_status)
+        finally:
+            self._lock.release()
+
+    def _read_request(self, sock):
+        try:
+            data = sock.recv(1024)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self._lock.acquire()
+            try:
+                if sock in self._subscribers:
+                    self._subscribers.remove(sock)
+                    sock.close()
+            finally:
+                self._lock.release()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+
+    """Stops calls being made to a server that isn't responding.
+
+    After max_failures consecutive calls have failed the breaker opens,
+    and calls fail straight away (with CircuitOpenError) rather than
+    waiting for the server. After reset_period seconds one call is let
+    through to see whether the server has come back. If it succeeds the
+    breaker closes again, otherwise it stays open for twice as long (up
+    to max_reset_period). Periods are randomised by up to +/- jitter (a
+    fraction), so that clients that lost the server at the same time
+    don't all come back at the same time.
+
+    """
+
+    def __init__(self, max_failures=3, reset_period=5, max_reset_period=300,
+                 jitter=0.5):
+        self.max_failures = max_failures
+        self.reset_period = reset_period
+        self.max_reset_period = max_reset_period
+        self.jitter = jitter
+        self._failures = 0
+        self._period = reset_period
+        self._retry_time = None
+
+    def _is_open(self):
+        return self._retry_time is not None
+
+    is_open = property(_is_open)
+
+    def allow(self):
+        """Return True if a call may be made now."""
+        if self._retry_time is None:
+            return True
+        now = time.time()
+        if now < self._retry_time:
+            return False
+        self._retry_time = now + self._period  # only let one call through
+        return True
+
+    def succeeded(self):
+        self._failures = 0
+        self._period = self.reset_period
+        self._retry_time = None
+
+    def failed(self):
+        self._failures += 1
+        if self._retry_time is not None:  # it's still not responding
+            self._period = min(self._period * 2, self.max_reset_period)
+        if self._failures >= self.max_failures:
+            jitter = random.uniform(-self.jitter, self.jitter)
+            self._retry_time = time.time() + self._period * (1 + jitter)
+
+
+def _monotonic_clock():
+    # The fifth of os.times() is the real time elapsed since a fixed
+    # point in the past, so (unlike time.time()) it isn't changed when
+    # the system clock is set. It's always zero where unsupported.
+    try:
+        if os.times()[4] != 0:
+            return lambda: os.times()[4]
+    except (AttributeError, OSError):
+        pass
+    return time.time
+
+monotonic = _monotonic_clock()
+
+
+class OnlineClock(object):
+
+    """Keeps track of how long the connection has been up.
+
+    The clock is set from the time on-line reported by the server and
+    then runs on a monotonic local clock, so setting the system time
+    (e.g. by NTP) doesn't make it jump. The server's figure is taken to
+    be correct half way through the round trip that fetched it. Later
+    figures only set the clock again if they differ from it by more
+    than max_drift seconds (e.g. the link has been re-established), so
+    variations in latency don't make the time on-line wobble.
+
+    The monotonic clock can stop while the machine is suspended. If
+    the system time moves on by more than max_drift seconds more than
+    the monotonic time the clock is stale, and should be set from the
+    server again.
+
+    """
+
+    def __init__(self, max_drift=2, clock=None, wall_clock=None):
+        if clock is None:
+            clock = monotonic
+        if wall_clock is None:
+            wall_clock = time.time
+        self.max_drift = max_drift
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._anchor = None  # (seconds on-line, monotonic time)
+        self._wall_offset = None
+        self.resyncs = 0
+
+    def _get_is_set(self):
+        return self._anchor is not None
+
+    is_set = property(_get_is_set)
+
+    def reset(self):
+        self._anchor = None
+
+    def sync(self, seconds_online, sent=None, received=None):
+        """Set the clock from the server, if it has drifted too far.
+
+        sent and received are the monotonic times at which the request
+        was sent and the reply arrived (by default, now). Returns True
+        if the clock was set.
+
+        """
+        now = self._clock()
+        self._wall_offset = self._wall_clock() - now
+        if received is None:
+            received = now
+        if sent is None:
+            sent = received
+        at = (sent + received) / 2.0
+        if self._anchor is not None:
+            expected = self._anchor[0] + at - self._anchor[1]
+            if abs(seconds_online - expected) <= self.max_drift:
+                return False
+            self.resyncs += 1
+        self._anchor = (seconds_online, at)
+        return True
+
+    def seconds(self):
+        """Return the time on-line, or 0 if the clock isn't set."""
+        if self._anchor is None:
+            return 0
+        return self._anchor[0] + self._clock() - self._anchor[1]
+
+    def is_stale(self):
+        if self._anchor is None:
+            return False
+        offset = self._wall_clock() - self._clock()
+        return abs(offset - self._wall_offset) > self.max_drift
 
 
 class RemoteModem(Observable):
 
-    def __init__(self, server_proxy):
+    CLIENT_ID_TTL = None  # seconds, or None for no expiry
+    MAX_CLOCK_ERROR = 2  # seconds the time on-line can drift by
+
+    def __init__(self, server_proxy, worker=None, client_id=None,
+                 breaker=None):
         Observable.__init__(self)
         self._server_proxy = server_proxy
+        self._worker = worker
+        self._breaker = breaker
+        self._in_flight = {}
+        self.calls_shared = 0
+        self.calls_avoided = 0
+        self._pending_connect = None
+        self._registered = False
+        self._watching = False
+        self.is_offline = False
         self._checking_status = False
+        self._fixed_client_id = client_id
+        self._client_id = None
+        self._client_id_hostname = None
+        self._client_id_expires = None
+        self.client_id_lookups_avoided = 0
+        self.is_subscribed = False
+        self.status_feed = None
+        self._methods = {}
+        self.stats = RpcStats()
         self.num_users = 0
         self.is_connected = False
         self.seconds_online = 0
+        self.clock = OnlineClock(self.MAX_CLOCK_ERROR)
 
-    def _get_client_id(self):
-        ip = socket.gethostbyname(socket.gethostname())
+    def _resolve_client_id(self, hostname):
+        ip = socket.gethostbyname(hostname)
         try:
             return "%s@%s" % (os.environ["USER"], ip)
         except KeyError:
             return ip
 
+    def _get_client_id(self):
+        if self._fixed_client_id is not None:
+            return self._fixed_client_id
+        # Looking up our own address can be slow, so we only do it
+        # again if our host name changes or the cached ID expires.
+        hostname = socket.gethostname()
+        now = time.time()
+        if self._client_id is None or \
+               hostname != self._client_id_hostname or \
+               (self._client_id_expires is not None and
+                now > self._client_id_expires):
+            self._client_id = self._resolve_client_id(hostname)
+            self._client_id_hostname = hostname
+            if self.CLIENT_ID_TTL is not None:
+                self._client_id_expires = now + self.CLIENT_ID_TTL
+        else:
+            self.client_id_lookups_avoided += 1
+        return self._client_id
+
     client_id = property(_get_client_id)
 
+    def _get_wants_connection(self):
+        return self._checking_status
+
+    wants_connection = property(_get_wants_connection)
+
+    def _get_needs_polling(self):
+        # The status is sent to subscribers as it changes, but while
+        # we're connecting we check for ourselves, as whoever sends it
+        # may not be checking very often.
+        return not self.is_subscribed or \
+               (self._checking_status and not self.is_connected)
+
+    needs_polling = property(_get_needs_polling)
+
+    def forget_client_id(self):
+        """Look up the client ID again the next time it's needed."""
+        self._client_id = None
+
+    def _call(self, method, args, callback, errback=None):
+        func = getattr(self._server_proxy, method)
+        return self._shared_call((method, args), method, func, args,
+                                 callback, errback)
+
+    def _shared_call(self, key, name, func, args, callback, errback=None):
+        """Call func, unless an identical call is already in progress.
+
+        Calls are identified by key. If a call with the same key has
+        been queued and hasn't finished yet, callback and errback wait
+        for its result rather than a second request being sent.
+
+        """
+        if self._worker is None:  # nothing can be in progress
+            return self._call_function(name, func, args, callback, errback)
+        entry = self._in_flight.get(key)
+        if entry is not None and not entry[0].cancelled:
+            entry[1].append((callback, errback))
+            self.calls_shared += 1
+            return entry[0]
+        waiters = [(callback, errback)]
+        def succeeded(result):
+            self._call_finished(key, waiters)
+            for callback, errback in waiters:
+                callback(result)
+        def failed(exc_info):
+            self._call_finished(key, waiters)
+            default = False
+            for callback, errback in waiters:
+                if errback is None:
+                    default = True
+                else:
+                    errback(exc_info)
+            if default:
+                self._default_errback(exc_info)
+        self._in_flight[key] = [None, waiters]
+        call = self._call_function(name, func, args, succeeded, failed)
+        # If results are dispatched on the worker's thread the call may
+        # have finished already.
+        entry = self._in_flight.get(key)
+        if entry is not None and entry[1] is waiters:
+            if call is None:  # rejected by the circuit breaker
+                self._call_finished(key, waiters)
+            else:
+                entry[0] = call
+        return call
+
+    def _call_finished(self, key, waiters):
+        entry = self._in_flight.get(key)
+        if entry is not None and entry[1] is waiters:
+            del self._in_flight[key]
+
+    def _timed(self, name, func):
+        def call(*args):
+            started = time.time()
+            try:
+                result = func(*args)
+            except:
+                self.stats.record(name, time.time() - started,
+                                  sys.exc_info()[0])
+                raise
+            self.stats.record(name, time.time() - started)
+            return result
+        return call
+
+    def _call_function(self, name, func, args, callback, errback=None):
+        """Call func, passing the result to callback.
+
+        If the call fails the exception info is passed to errback (by
+        default the exception is re-raised). If the modem has a circuit
+        breaker, failing to contact the server isn't treated as an
+        error; the modem goes off-line (and tries again later), and
+        errback is only called if one was given.
+
+        Returns an RpcCall if the call was queued on a worker.
+
+        """
+        if self._breaker is not None and not self._breaker.allow():
+            try:
+                raise CircuitOpenError, "server off-line"
+            except CircuitOpenError:
+                self._call_failed(sys.exc_info(), errback)
+            return None
+        func = self._timed(name, func)
+        succeeded = lambda result: self._call_succeeded(result, callback)
+        failed = lambda exc_info: self._call_failed(exc_info, errback)
+        if self._worker is None:
+            try:
+                result = func(*args)
+            except:
+                failed(sys.exc_info())
+            else:
+                succeeded(result)
+        else:
+            return self._worker.call(func, args, succeeded, failed)
+
+    def _set_offline(self, is_offline):
+        self._update({"is_offline": is_offline})
+
+    def _update(self, values):
+        """Set attributes, and notify observers if any of them change."""
+        changes = {}
+        for name, value in values.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changes[name] = None
+        if changes:
+            self.notify_observers(changes)
+
+    def _call_succeeded(self, result, callback):
+        if self._breaker is not None:
+            self._breaker.succeeded()
+            self._set_offline(False)
+        callback(result)
+
+    def _call_failed(self, exc_info, errback):
+        if issubclass(exc_info[0], socket.error):
+            self.forget_client_id()  # our address may have changed
+            if self._breaker is not None:
+                self._breaker.failed()
+        if self._breaker is not None and \
+               issubclass(exc_info[0], (socket.error, CircuitOpenError)):
+            self._set_offline(True)
+        if errback is None:
+            errback = self._default_errback
+        errback(exc_info)
+
+    def _default_errback(self, exc_info):
+        if self._breaker is not None and \
+               issubclass(exc_info[0], (socket.error, CircuitOpenError)):
+            return  # we're off-line, and will try again later
+        self._reraise(exc_info)
+
+    def _reraise(self, exc_info):
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _ignore_result(self, result):
+        pass
+
+    def _ignore_error(self, exc_info):
+        pass
+
+    def detect_capabilities(self, callback=None):
+        """Find out which methods the server supports.
+
+        Servers that don't support introspection are assumed to
+        support only the basic methods. The callback (if given) is
+        called once we know, whether or not the server told us.
+
+        """
+        def detected(methods):
+            self._capabilities_detected(methods)
+            if callback is not None:
+                callback()
+        def failed(exc_info):
+            if callback is not None:
+                callback()
+        self._call("system.listMethods", (), detected, failed)
+
+    def _capabilities_detected(self, methods):
+        self._methods = {}
+        for method in methods:
+            self._methods[method] = None
+
+    def supports(self, method):
+        return method in self._methods
+
+    def _multicall(self, calls):
+        # Runs on the worker thread (if there is one).
+        params = []
+        for method, args in calls:
+            params.append({"methodName": method, "params": list(args)})
+        results = []
+        for result in self._server_proxy.system.multicall(params):
+            if isinstance(result, dict):
+                raise xmlrpclib.Fault(result["faultCode"],
+                                      result["faultString"])
+            results.append(result[0])
+        return results
+
+    def _batch(self, calls, callback, errback=None):
+        """Make several calls in one request, if the server allows it.
+
+        The callback is passed a list of the results.
+
+        """
+        name = "+".join([method for method, args in calls])
+        if self.supports("system.multicall"):
+            func = self._multicall
+        else:
+            def func(calls):
+                results = []
+                for method, args in calls:
+                    func = getattr(self._server_proxy, method)
+                    results.append(func(*args))
+                return results
+        return self._shared_call(tuple(calls), name, func, (calls, ),
+                                 callback, errback)
+
     def connect(self):
-        self._server_proxy.connect(self.client_id)
         self._checking_status = True
+        if self._pending_connect is not None and \
+               self._pending_connect.started:
+            self._registered = True
+        if self.supports("system.multicall"):
+            client_id = self.client_id
+            self._pending_connect = self._batch(
+                [("connect", (client_id, )), ("get_status", (client_id, ))],
+                self._connected)
+        else:
+            self._pending_connect = self._call(
+                "connect", (self.client_id, ), self._ignore_result)
+
+    def watch(self):
+        """Keep track of the status, without connecting."""
+        self._watching = True
+
+    def _connected(self, results):
+        self._status_received(results[1])
+
+    def disconnect(self, all=False):
+        all = xmlrpclib.boolean(all)
+        registered = self._registered or self._pending_connect is None
+        if self._pending_connect is not None:
+            # If the connect hasn't been sent yet the server needn't
+            # hear about either of them (unless we're hanging up for
+            # everybody).
+            if not self._pending_connect.cancel():
+                registered = True
+            self._pending_connect = None
+        self._checking_status = False
+        self._update({"is_connected": False})
+        if registered or all:
+            self._call("disconnect", (self.client_id, all),
+                       self._ignore_result)
+        else:
+            self.calls_avoided += 2
+        self._registered = False
+
+    def hung_up(self):
+        """Stop wanting a connection, after somebody hung up for everybody.
+
+        The server has already forgotten us, so it isn't told.
 
-    def disconnect(self, all=xmlrpclib.False):
-        if bool(all):
-            all = xmlrpclib.True
+        """
+        self._pending_connect = None
         self._checking_status = False
-        self.is_connected = False
-        self.notify_observers()
-        self._server_proxy.disconnect(self.client_id, all)
+        self._registered = False
+
+    def get_status(self, errback=None, callback=None):
+        """Bring the status up to date, if we're interested in it.
+
+        Observers are only notified if the status changes. The callback
+        (if given) is called once the status has been checked, whether
+        or not it has changed.
+
+        """
+        # While off-line we keep asking, to find out when we're back,
+        # and if we're sharing the status with other clients we ask on
+        # their behalf.
+        feed = self.status_feed
+        if self.needs_polling and \
+               (self._checking_status or self._watching or self.is_offline or
+                (feed is not None and feed.has_subscribers)):
+            def fetch(client_id):
+                sent = monotonic()
+                status = self._server_proxy.get_status(client_id)
+                return status, sent, monotonic()
+            def received(result):
+                self._status_received(*result)
+                if callback is not None:
+                    callback()
+            args = (self.client_id, )
+            self._shared_call(("get_status", args), "get_status", fetch,
+                              args, received, errback)
+        elif callback is not None:
+            callback()
+
+    def _status_received(self, status, sent=None, received=None):
+        if self.status_feed is not None:
+            self.status_feed.publish(status)
+        if not (self._checking_status or self._watching):
+            return  # ignore replies that arrive too late
+        num_users, is_connected, seconds_online = status
+        # The time on-line only counts as a change if it doesn't follow
+        # on from the last status (e.g. the link was re-established).
+        if not is_connected:
+            self.clock.reset()
+            self.seconds_online = seconds_online
+        elif not self.clock.sync(seconds_online, sent, received):
+            self.seconds_online = seconds_online
+        self._update({"num_users": num_users, "is_connected": is_connected,
+                      "seconds_online": seconds_online})
+
+    def status_pushed(self, status):
+        """Accept a status sent by a StatusSubscription."""
+        self._update({"is_subscribed": True})
+        self._status_received(status)
+
+    def unsubscribed(self):
+        """Go back to polling for the status."""
+        self._update({"is_subscribed": False})
+
+    def close(self, timeout=None):
+        """Wait (for up to timeout seconds) for queued calls to finish."""
+        if self._worker is not None:
+            self._worker.stop(timeout)
+
+
+class PollScheduler(object):
+
+    """Checks the modem's status at a fixed interval.
+
+    A scheduler is told what is going on (a connection being made, the
+    user clicking a button, a status check succeeding or failing) and
+    decides how many seconds to wait before the next status check.
+
+    """
+
+    def __init__(self, period=2):
+        self.period = period
+
+    def next_delay(self):
+        return self.period
+
+    def connecting(self, eta=None):
+        pass
+
+    def user_action(self):
+        pass
+
+    def succeeded(self, is_connected, wants_connection=True):
+        pass
+
+    def failed(self):
+        pass
+
+    def set_idle(self, idle):
+        pass
+
+
+class AdaptivePollScheduler(PollScheduler):
+
+    """Checks often when something is happening, and rarely when not.
+
+    While a connection is being made, or just after the user has done
+    something, the status is checked every fast_period seconds. Once
+    the link is stable the period grows by a factor of growth on each
+    check, up to slow_period. Failed checks back off exponentially, up
+    to max_period. Every delay is randomised by up to +/- jitter (a
+    fraction of the delay) so that clients don't all poll in step.
+    While the window is idle (i.e. can't be seen) delays are
+    multiplied by idle_factor.
+
+    If connecting is expected to take eta seconds, the status is
+    checked half way to the expected time (getting closer with each
+    check) rather than every fast_period seconds. Connecting ends when
+    the link comes up, or when the client stops wanting a connection
+    (e.g. the user cancels).
+
+    """
+
+    def __init__(self, fast_period=0.5, slow_period=30, max_period=120,
+                 growth=1.5, jitter=0.1, idle_factor=4):
+        PollScheduler.__init__(self, fast_period)
+        self.fast_period = fast_period
+        self.slow_period = slow_period
+        self.max_period = max_period
+        self.growth = growth
+        self.jitter = jitter
+        self.idle_factor = idle_factor
+        self._connecting = False
+        self._expected = None
+        self._failures = 0
+        self._idle = False
+
+    def next_delay(self):
+        delay = self.period
+        if self._idle and not self._connecting:
+            delay = min(delay * self.idle_factor, self.max_period)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def set_idle(self, idle):
+        self._idle = idle
+
+    def connecting(self, eta=None):
+        self._connecting = True
+        self._expected = None
+        if eta is not None:
+            self._expected = time.time() + eta
+        self.user_action()
+
+    def _connecting_period(self):
+        if self._expected is None:
+            return self.fast_period
+        return max((self._expected - time.time()) / 2, self.fast_period)
+
+    def user_action(self):
+        self._failures = 0
+        self.period = self.fast_period
+
+    def succeeded(self, is_connected, wants_connection=True):
+        self._failures = 0
+        if self._connecting and wants_connection and not is_connected:
+            self.period = self._connecting_period()
+        else:
+            self._connecting = False
+            self._expected = None
+            self.period = min(self.period * self.growth, self.slow_period)
+
+    def failed(self):
+        self._failures += 1
+        self.period = min(self.fast_period * 2 ** self._failures,
+                          self.max_period)
+
+
+POLL_SCHEDULERS = {
+    "fixed": PollScheduler,
+    "adaptive": AdaptivePollScheduler,
+}
+
+
+def _keyword_args(cls):
+    """Return the names of the arguments of a class's constructor."""
+    code = cls.__init__.im_func.func_code
+    return code.co_varnames[1:code.co_argcount]
+
+
+class ConnectTimeEstimator(object):
+
+    """Predicts how long connecting will take, from previous connects.
+
+    The time taken by each connect that involved dialling (i.e. the
+    server wasn't already connected when we asked) is recorded, and the
+    estimate is the median of the last max_samples of them. If a path
+    is given the times are saved in it, so they survive a restart.
+    connecting() should only be called when the user asks to connect;
+    a connect starts again when the user asks again, but not when the
+    client redials by itself.
+
+    """
+
+    def __init__(self, path=None, max_samples=20):
+        self.path = path
+        self.max_samples = max_samples
+        self.times = self._load()
+        self._started = None
+        self._dialling = False
+
+    def _load(self):
+        times = []
+        if self.path is not None:
+            try:
+                times_file = file(self.path)
+                try:
+                    for line in times_file:
+                        times.append(float(line))
+                finally:
+                    times_file.close()
+            except (IOError, ValueError):
+                pass
+        return times[-self.max_samples:]
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            times_file = file(self.path, "w")
+            try:
+                for seconds in self.times:
+                    times_file.write("%.1f\n" % seconds)
+            finally:
+                times_file.close()
+        except IOError:
+            pass
+
+    def estimate(self):
+        """Return the expected time to connect, or None if unknown."""
+        if not self.times:
+            return None
+        times = self.times[:]
+        times.sort()
+        return times[len(times) / 2]
+
+    def add(self, seconds):
+        self.times = (self.times + [seconds])[-self.max_samples:]
+        self._save()
+
+    def connecting(self):
+        self._started = monotonic()
+        self._dialling = False
+
+    def cancelled(self):
+        self._started = None
+
+    def status_checked(self, is_connected):
+        if self._started is None:
+            return
+        if not is_connected:
+            self._dialling = True
+        else:
+            if self._dialling:
+                self.add(monotonic() - self._started)
+            self._started = None
+
+
+def connect_progress(elapsed, estimate):
+    """Return the fraction of a connect that's done, and a description.
+
+    The fraction is None if there's no telling how far through it is.
+
+    """
+    if estimate is None:
+        return None, ""
+    remaining = estimate - elapsed
+    if remaining <= 0:
+        return None, "Taking longer than usual..."
+    return (float(elapsed) / estimate,
+            "About %d seconds left" % math.ceil(remaining))
+
+
+class ReconnectSupervisor(object):
+
+    """Notices when the connection drops, and optionally redials.
+
+    A connection has dropped if the modem stops being connected while
+    the client still wants it to be (i.e. the user hasn't asked to
+    disconnect). If nobody is left using the connection somebody has
+    hung up for everybody, which isn't a drop either; the modem is told
+    to stop wanting a connection. For a drop, the listener's dropped()
+    method is called, and if
+    redial is set the supervisor calls connect() again, waiting
+    min_delay seconds before the first attempt and twice as long before
+    each one after that, up to max_delay. The listener's redialling()
+    and recovered() methods are called as the connection comes back.
+
+    The supervisor keeps count of drops and of the time that was spent
+    without a connection because of them.
+
+    """
+
+    def __init__(self, modem, timers, listener, redial=True, min_delay=5,
+                 max_delay=300):
+        self._modem = modem
+        self._timers = timers
+        self._listener = listener
+        self.redial = redial
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._was_connected = modem.is_connected
+        self._dropped_at = None
+        self._delay = min_delay
+        self._redial_timeout = None
+        self._started = time.time()
+        self.drops = 0
+        self.recoveries = 0
+        self.seconds_lost = 0
+        self.recovery_seconds = 0
+        modem.add_observer(self)
+
+    def update(self):
+        is_connected = self._modem.is_connected
+        if self._dropped_at is None:
+            if self._was_connected and not is_connected and \
+                   self._modem.wants_connection:
+                # After a real drop we're still one of the users.
+                if self._modem.num_users == 0:
+                    self._modem.hung_up()
+                else:
+                    self._dropped()
+        elif is_connected:
+            self._recovered()
+        elif not self._modem.wants_connection:
+            self._given_up()
+        self._was_connected = is_connected
+
+    def _dropped(self):
+        self._dropped_at = time.time()
+        self.drops += 1
+        self._listener.dropped(self.redial)
+        if self.redial:
+            self._delay = self.min_delay
+            self._schedule_redial()
+
+    def _schedule_redial(self):
+        self._redial_timeout = self._timers.add(self._delay, self._redial)
+
+    def _redial(self):
+        self._redial_timeout = None
+        self._modem.connect()
+        self._listener.redialling()
+        self._delay = min(self._delay * 2, self.max_delay)
+        self._schedule_redial()
+        return False
+
+    def _stop_redialling(self):
+        if self._redial_timeout is not None:
+            self._timers.remove(self._redial_timeout)
+            self._redial_timeout = None
+        lost = time.time() - self._dropped_at
+        self._dropped_at = None
+        self.seconds_lost += lost
+        return lost
+
+    def _recovered(self):
+        self.recovery_seconds += self._stop_redialling()
+        self.recoveries += 1
+        self._listener.recovered()
+
+    def _given_up(self):
+        self._stop_redialling()
+
+    def report(self):
+        """Return a description of the drops, as a list of lines."""
+        days = max(time.time() - self._started, 1) / (24 * 60 * 60.0)
+        lines = ["connection drops: %d, recovered: %d" %
+                 (self.drops, self.recoveries)]
+        if self.recoveries:
+            lines.append("mean time to recover: %.1f s" %
+                         (self.recovery_seconds / self.recoveries))
+        lines.append("time lost to drops: %.1f min (%.1f min per day)" %
+                     (self.seconds_lost / 60, self.seconds_lost / 60 / days))
+        return lines
+
+
+class StatusHistory(object):
+
+    """Remembers how the status has changed, in a fixed amount of memory.
+
+    A sample (the time, the number of users and whether the server is
+    connected) is added whenever the number of users or the connection
+    state changes. Samples are stored in arrays that are used as a
+    ring buffer, so once capacity samples have been added each new one
+    replaces the oldest.
+
+    If a HistoryLog is given, the samples already in it are loaded and
+    each new sample is written to it.
+
+    """
+
+    def __init__(self, modem=None, capacity=10000, log=None):
+        import array
+        self.capacity = capacity
+        self._times = array.array("d", [0.0] * capacity)
+        self._users = array.array("H", [0] * capacity)
+        self._connected = array.array("B", [0] * capacity)
+        self._next = 0
+        self._count = 0
+        self._modem = modem
+        self._log = log
+        if log is not None:
+            for when, num_users, is_connected in log.read():
+                self._add(when, num_users, is_connected)
+        if modem is not None:
+            modem.add_observer(self)
+
+    def __len__(self):
+        return self._count
+
+    def update(self, changes):
+        if "num_users" in changes or "is_connected" in changes:
+            self.add(time.time(), self._modem.num_users,
+                     self._modem.is_connected)
+
+    def _add(self, when, num_users, is_connected):
+        i = self._next
+        self._times[i] = when
+        self._users[i] = num_users
+        self._connected[i] = bool(is_connected)
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def add(self, when, num_users, is_connected):
+        self._add(when, num_users, is_connected)
+        if self._log is not None:
+            self._log.write(when, num_users, is_connected)
+
+    def samples(self, since=0):
+        """Return (time, users, connected) tuples, oldest first.
+
+        The samples are those taken since the given time, preceded by
+        the last one taken before it (if any), which shows what the
+        status was at that time.
+
+        """
+        samples = []
+        first = self._next - self._count
+        for i in range(first, self._next):
+            i = i % self.capacity
+            sample = (self._times[i], self._users[i],
+                      bool(self._connected[i]))
+            if sample[0] < since:
+                samples = [sample]
+            else:
+                samples.append(sample)
+        return samples
+
+    def peak_users(self, since=0):
+        peak = 0
+        for when, num_users, is_connected in self.samples(since):
+            peak = max(peak, num_users)
+        return peak
+
+
+class HistoryLog(object):
+
+    """Appends history samples to a file, a batch at a time.
+
+    Samples are kept in memory until flush() is called (e.g. every few
+    minutes, and on exit). When the file would grow beyond max_bytes it
+    is renamed to path.1 (path.1 becomes path.2, and so on, keeping up
+    to backups old files) and a new file is started.
+
+    """
+
+    def __init__(self, path, max_bytes=1000000, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._pending = []
+
+    def write(self, when, num_users, is_connected):
+        self._pending.append("%d %d %d\n" % (when, num_users, is_connected))
+
+    def flush(self):
+        if self._pending:
+            data = "".join(self._pending)
+            self._pending = []
+            try:
+                try:
+                    size = os.path.getsize(self.path)
+                except os.error:
+                    size = 0
+                if size > 0 and size + len(data) > self.max_bytes:
+                    self._rotate()
+                log_file = file(self.path, "a")
+                try:
+                    log_file.write(data)
+                finally:
+                    log_file.close()
+            except (IOError, OSError):
+                pass  # losing some history is better than stopping
+        return True
+
+    def _rotate(self):
+        if self.backups == 0:
+            os.remove(self.path)
+            return
+        oldest = "%s.%d" % (self.path, self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, i + 1))
+        os.rename(self.path, self.path + ".1")
+
+    def read(self):
+        """Return the samples in the current file, oldest first."""
+        try:
+            log_file = file(self.path)
+        except IOError:
+            return []
+        samples = []
+        try:
+            for line in log_file:
+                try:
+                    when, num_users, is_connected = line.split()
+                    samples.append((float(when), int(num_users),
+                                    bool(int(is_connected))))
+                except ValueError:
+                    continue  # e.g. a line cut short by a crash
+        finally:
+            log_file.close()
+        return samples
+
+
+def history_graph(samples, now, span, width, height):
+    """Work out how to draw samples from the last span seconds.
+
+    Returns a list of (x1, x2) ranges during which the server was
+    connected, and the points of a line showing the number of users
+    (scaled so that the busiest time reaches the top).
+
+    """
+    start = now - span
+    peak = 1
+    for when, num_users, is_connected in samples:
+        peak = max(peak, num_users)
+
+    def x(when):
+        return int((max(when, start) - start) * (width - 1) / span)
+
+    def y(num_users):
+        return height - 1 - num_users * (height - 1) / peak
+
+    sessions = []
+    points = []
+    for i in range(len(samples)):
+        when, num_users, is_connected = samples[i]
+        if i + 1 < len(samples):
+            until = samples[i + 1][0]
+        else:
+            until = now
+        if until < start:
+            continue
+        if is_connected:
+            if sessions and sessions[-1][1] == x(when):
+                sessions[-1] = (sessions[-1][0], x(until))
+            else:
+                sessions.append((x(when), x(until)))
+        points.append((x(when), y(num_users)))
+        points.append((x(until), y(num_users)))
+    return sessions, points
+
+
+class TimerManager(object):
+
+    """Runs timers in the GTK main loop, and counts the wakeups.
+
+    Timers whose period is a whole number of seconds are added with
+    timeout_add_seconds (when PyGTK has it), which lets GLib wake up
+    once for several of them. Timers that only update the display
+    ("ui" timers) are suspended while their window can't be seen. The
+    ui argument is True for the main window; other windows pass a name
+    of their own to add() and set_visible().
+
+    Periods are in seconds. As with gobject.timeout_add, a timer is
+    removed when its callback returns False.
+
+    """
+
+    def __init__(self):
+        self._timers = {}  # id -> [seconds, callback, ui, source]
+        self._next_id = 1
+        self._hidden = {}  # the windows that can't be seen
+        self._started = time.time()
+        self.wakeups = 0
+
+    def add(self, seconds, callback, ui=False):
+        timer_id = self._next_id
+        self._next_id += 1
+        self._timers[timer_id] = [seconds, callback, ui, None]
+        if not ui or ui not in self._hidden:
+            self._start(timer_id)
+        return timer_id
+
+    def _start(self, timer_id):
+        timer = self._timers[timer_id]
+        seconds = timer[0]
+        if seconds >= 1 and seconds == int(seconds) and \
+               hasattr(gobject, "timeout_add_seconds"):
+            timer[3] = gobject.timeout_add_seconds(int(seconds), self._fire,
+                                                   timer_id)
+        else:
+            timer[3] = gobject.timeout_add(int(seconds * 1000), self._fire,
+                                           timer_id)
+
+    def _stop(self, timer_id):
+        timer = self._timers[timer_id]
+        if timer[3] is not None:
+            gobject.source_remove(timer[3])
+            timer[3] = None
+
+    def remove(self, timer_id):
+        if timer_id in self._timers:
+            self._stop(timer_id)
+            del self._timers[timer_id]
+
+    def _fire(self, timer_id):
+        self.wakeups += 1
+        if self._timers[timer_id][1]():
+            return True
+        if timer_id in self._timers:
+            del self._timers[timer_id]
+        return False
+
+    def set_visible(self, visible, ui=True):
+        """Suspend or resume the timers that update window ui."""
+        if visible == (ui not in self._hidden):
+            return
+        if visible:
+            del self._hidden[ui]
+        else:
+            self._hidden[ui] = None
+        for timer_id, timer in self._timers.items():
+            if timer[2] == ui:
+                if visible:
+                    self._start(timer_id)
+                else:
+                    self._stop(timer_id)
+
+    def wakeups_per_second(self):
+        return self.wakeups / max(time.time() - self._started, 1)
+
 
-    def get_status(self):
-        if self._checking_status:
-            self.num_users, self.is_connected, self.seconds_online = \
-                            self._server_proxy.get_status(self.client_id)
-        self.notify_observers()
+class GladeCache(object):
+
+    """Reads the glade file once, and builds widgets from memory.
+
+    preload() builds widget trees in advance, when the main loop is
+    idle, so that dialogs can be shown without any delay.
+
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._buffer = None
+        self._preloaded = {}
+
+    def _build(self, root_widget):
+        if self._buffer is None:
+            self._buffer = file(self._filename).read()
+        return gtk.glade.xml_new_from_buffer(self._buffer, len(self._buffer),
+                                             root_widget)
+
+    def get(self, root_widget):
+        trees = self._preloaded.get(root_widget)
+        if trees:
+            tree = trees.pop()
+            self.preload([root_widget])  # get the next one ready
+            return tree
+        return self._build(root_widget)
+
+    def preload(self, root_widgets):
+        remaining = list(root_widgets)
+
+        def build_next():
+            root_widget = remaining.pop(0)
+            if not self._preloaded.get(root_widget):
+                self._preloaded[root_widget] = [self._build(root_widget)]
+            return len(remaining) > 0
+
+        gobject.idle_add(build_next)
 
 
 class WidgetWrapper(object):
 
+    glade = GladeCache(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "landialler.glade"))
+
+    _handler_names = {}  # class -> names of its methods
+
     def __init__(self, root_widget):
-        self._root_widget_name = root_widget
-        self._xml = gtk.glade.XML("landialler.glade", root_widget)
+        self._xml = self.glade.get(root_widget)
+        self._root_widget = self._xml.get_widget(root_widget)
         self._connect_signals()
 
     def _get_root_widget(self):
-        return getattr(self, self._root_widget_name)
+        return self._root_widget
 
     root_widget = property(_get_root_widget)
 
@@ -155,14 +2248,28 @@ class WidgetWrapper(object):
         widget = self._xml.get_widget(name)
         if widget is None:
             raise AttributeError, name
+        self.__dict__[name] = widget  # so we don't come here next time
         return widget
-    
+
+    def _get_handler_names(self):
+        cls = self.__class__
+        try:
+            return WidgetWrapper._handler_names[cls]
+        except KeyError:
+            names = []
+            for klass in cls.__mro__:
+                if klass is not object:
+                    for name, value in klass.__dict__.items():
+                        if callable(value) and name not in names:
+                            names.append(name)
+            WidgetWrapper._handler_names[cls] = names
+            return names
+
     def _connect_signals(self):
-        for name in self.__class__.__dict__.keys():
-            if hasattr(self, name):
-                candidate_callback = getattr(self, name)
-                if callable(candidate_callback):
-                    self._xml.signal_connect(name, candidate_callback)
+        handlers = {}
+        for name in self._get_handler_names():
+            handlers[name] = getattr(self, name)
+        self._xml.signal_autoconnect(handlers)
 
 
 class Window(WidgetWrapper):
@@ -180,114 +2287,334 @@ class Dialog(Window):
         self.root_widget.run()
 
 
-class MainWindow(Window):
+class StatusDisplay(object):
+
+    """Decides what the main window shows, and keeps it up to date.
+
+    The display remembers what each widget is showing and only updates
+    the ones whose contents have changed. The on-line time is shown to
+    the nearest second, so nothing changes between whole seconds.
+
+    """
 
-    CHECK_STATUS_PERIOD = 1000 * 2
     STATUS_LABEL = '<span size="larger" weight="bold">You are %s</span>'
     TITLE = "LANdialler"
-    UPDATE_TIMER_PERIOD = 100
 
-    def __init__(self, modem):
+    def __init__(self, window):
+        self._setters = {
+            "status": window.status_label.set_label,
+            "details": window.details_label.set_label,
+            "title": window.root_widget.set_title,
+            "connect_sensitive": window.connect_button.set_sensitive,
+            "disconnect_sensitive": window.disconnect_button.set_sensitive
+        }
+        self._shown = {}
+        self._connected_as = None
+
+    def _show(self, state):
+        for name, value in state.items():
+            if name not in self._shown or self._shown[name] != value:
+                self._setters[name](value)
+                self._shown[name] = value
+
+    def show_connected(self, num_users, seconds_online):
+        seconds_online = int(seconds_online)
+        if self._connected_as == (num_users, seconds_online):
+            return
+        self._connected_as = (num_users, seconds_online)
+        time_str = time.strftime("%H:%M:%S", time.gmtime(seconds_online))
+        user_str = { True: "user", False: "users" }[num_users == 1]
+        self._show({
+            "status": self.STATUS_LABEL % "connected",
+            "details": "%s %s, on-line for %s" %
+                       (num_users, user_str, time_str),
+            "title": "%s (connected)" % self.TITLE,
+            "connect_sensitive": False,
+            "disconnect_sensitive": True
+        })
+
+    def show_offline(self):
+        self._connected_as = None
+        self._show({
+            "status": self.STATUS_LABEL % "off-line",
+            "details": "Can't contact the server, retrying...",
+            "title": "%s (off-line)" % self.TITLE,
+            "connect_sensitive": False,
+            "disconnect_sensitive": False
+        })
+
+    def show_disconnected(self):
+        self._connected_as = None
+        self._show({
+            "status": self.STATUS_LABEL % "disconnected",
+            "details": "",
+            "title": self.TITLE,
+            "connect_sensitive": True,
+            "disconnect_sensitive": False
+        })
+
+
+class MainWindow(Window):
+
+    # Delays this long are rounded to whole seconds, so that the status
+    # check can share a wakeup with other timers. Shorter ones would
+    # lose most of the scheduler's jitter, and with it the spread of
+    # clients' checks over time.
+    ROUNDED_DELAY = 10
+
+    def __init__(self, modem, scheduler=None, timers=None, history=None,
+                 graph_span=24 * 60 * 60, estimator=None):
         Window.__init__(self, "main_window")
         self._modem = modem
         self._modem.add_observer(self)
-        self._set_status_disconnected()
-        self._seconds_online = 0
-        self._last_check_time = None
+        if scheduler is None:
+            scheduler = PollScheduler()
+        self._scheduler = scheduler
+        if timers is None:
+            timers = TimerManager()
+        self._timers = timers
+        self._history = history
+        self._graph_span = graph_span
+        if estimator is None:
+            estimator = ConnectTimeEstimator()
+        self._estimator = estimator
+        if history is not None:
+            self.history_graph.show()
+            # redraw often enough for the graph to move a pixel at a time
+            self._timers.add(max(graph_span / 200, 60), self._redraw_graph,
+                             ui=True)
+        self._display = StatusDisplay(self)
+        self._display.show_disconnected()
         self._status_timeout = None
-        gobject.timeout_add(self.UPDATE_TIMER_PERIOD, self._update_timer)
-        self.connect()
-
-    def update(self):
-        self._last_check_time = time.time()
-        if self._modem.is_connected:
-            self._set_status_connected(self._modem.seconds_online)
+        self._timer_timeout = None
+        self._resyncing = False
+        self._iconified = False
+        self._obscured = False
+        self._dropped_dialog = None
+        self.root_widget.add_events(gtk.gdk.VISIBILITY_NOTIFY_MASK)
+        self.root_widget.connect("window-state-event",
+                                 self._window_state_changed)
+        self.root_widget.connect("visibility-notify-event",
+                                 self._visibility_changed)
+
+    def update(self, changes):
+        if self._modem.is_offline:
+            self._stop_timer()
+            self._display.show_offline()
+        elif self._modem.is_connected:
+            self._update_timer()
         else:
-            self._set_status_disconnected()
+            self._stop_timer()
+            self._display.show_disconnected()
+        if "num_users" in changes or "is_connected" in changes:
+            self._redraw_graph()
+        if "is_connected" in changes:
+            self._connection_progress()
+        if "is_subscribed" in changes and self._modem.needs_polling:
+            self._schedule_status_check()
+
+    def _connection_progress(self):
+        if self._modem.wants_connection:
+            self._estimator.status_checked(self._modem.is_connected)
+        else:
+            self._estimator.cancelled()
+
+    def _redraw_graph(self):
+        if self._history is not None:
+            self.history_graph.queue_draw()
         return True
-            
-    def _set_status_label(self, status):
-        self.status_label.set_label(self.STATUS_LABEL % status)
 
-    def _set_status_connected(self, seconds_online):
-        self._set_status_label("connected")
-        time_str = time.strftime("%H:%M:%S", time.gmtime(seconds_online))
-        user_str = { True: "user", False: "users" }[self._modem.num_users == 1]
-        self.details_label.set_label(
-            "%s %s, on-line for %s" %
-            (self._modem.num_users, user_str, time_str))
-        self.root_widget.set_title("%s (connected)" % MainWindow.TITLE)
-        self.connect_button.set_sensitive(False)
-        self.disconnect_button.set_sensitive(True)
+    def on_history_graph_expose_event(self, widget, event):
+        if self._history is None:
+            return False
+        width, height = widget.allocation.width, widget.allocation.height
+        now = time.time()
+        sessions, points = history_graph(
+            self._history.samples(now - self._graph_span), now,
+            self._graph_span, width, height)
+        style = widget.style
+        window = widget.window
+        window.draw_rectangle(style.base_gc[gtk.STATE_NORMAL], True,
+                              0, 0, width, height)
+        for x1, x2 in sessions:
+            window.draw_rectangle(style.bg_gc[gtk.STATE_SELECTED], True,
+                                  x1, 0, max(x2 - x1, 1), height)
+        if len(points) > 1:
+            window.draw_lines(style.fg_gc[gtk.STATE_NORMAL], points)
+        return True
+
+    def _window_state_changed(self, widget, event):
+        hidden = (gtk.gdk.WINDOW_STATE_ICONIFIED |
+                  gtk.gdk.WINDOW_STATE_WITHDRAWN)
+        self._iconified = bool(event.new_window_state & hidden)
+        self._visibility_updated()
+
+    def _visibility_changed(self, widget, event):
+        self._obscured = event.state == gtk.gdk.VISIBILITY_FULLY_OBSCURED
+        self._visibility_updated()
+
+    def _visibility_updated(self):
+        visible = not (self._iconified or self._obscured)
+        self._timers.set_visible(visible)
+        self._scheduler.set_idle(not visible)
+        if visible:
+            self._update_timer()
+
+    def _stop_timer(self):
+        if self._timer_timeout:
+            self._timers.remove(self._timer_timeout)
+            self._timer_timeout = None
 
     def _update_timer(self):
+        self._stop_timer()
         if self._modem.is_connected:
-            secs_since_check = time.time() - self._last_check_time
-            secs_online = self._modem.seconds_online + secs_since_check
-            self._set_status_connected(secs_online)
-        return True
-
-    def _set_status_disconnected(self):
-        self._set_status_label("disconnected")
-        self.details_label.set_label("")
-        self.root_widget.set_title(MainWindow.TITLE)
-        self.connect_button.set_sensitive(True)
-        self.disconnect_button.set_sensitive(False)
+            secs_online = self._modem.clock.seconds()
+            self._display.show_connected(self._modem.num_users, secs_online)
+            # wake up just after the displayed time next changes
+            delay = 1 - secs_online % 1 + 0.01
+            self._timer_timeout = self._timers.add(delay, self._tick, ui=True)
+
+    def _tick(self):
+        self._timer_timeout = None
+        # If we've been suspended the time on-line needs checking.
+        if not self._modem.clock.is_stale():
+            self._resyncing = False
+        elif not self._resyncing:
+            self._resyncing = True
+            self._scheduler.user_action()
+            self._schedule_status_check()
+        self._update_timer()
+        return False
 
     def on_main_window_delete_event(self, *args):
         self._modem.remove_observer(self)
-        try:
-            if self._modem.is_connected:
-                self._modem.disconnect()
-        except socket.error:
-            pass
+        if self._modem.is_connected:
+            self._modem.disconnect()
         gtk.main_quit()
 
+    def _schedule_status_check(self):
+        if self._status_timeout:
+            self._timers.remove(self._status_timeout)
+            self._status_timeout = None
+        if not self._modem.needs_polling:
+            return  # the status is sent to us as it changes
+        delay = self._scheduler.next_delay()
+        if delay >= self.ROUNDED_DELAY:
+            delay = round(delay)
+        self._status_timeout = self._timers.add(delay, self._check_status)
+
     def _check_status(self):
-        self._modem.get_status()
-        return True
+        self._status_timeout = None
+        self._modem.get_status(self._status_check_failed,
+                               self._status_checked)
+        return False
+
+    def _status_checked(self):
+        if not self._modem.is_offline:
+            self._connection_progress()
+            self._scheduler.succeeded(self._modem.is_connected,
+                                      self._modem.wants_connection)
+        self._schedule_status_check()
+
+    def _status_check_failed(self, exc_info):
+        self._scheduler.failed()
+        self._schedule_status_check()
+        if not self._modem.is_offline:
+            raise exc_info[0], exc_info[1], exc_info[2]
 
     def connect(self):
-        if self._status_timeout:
-            gobject.source_remove(self._status_timeout)
-        self._status_timeout = gobject.timeout_add(
-            self.CHECK_STATUS_PERIOD, self._check_status)
+        estimate = self._estimator.estimate()
+        self._scheduler.connecting(estimate)
+        self._estimator.connecting()
         self._modem.connect()
-        dialog = ConnectingDialog(self._modem)
+        self._schedule_status_check()
+        dialog = ConnectingDialog(self._modem, self._timers, estimate)
         dialog.show()
 
     def on_connect_button_clicked(self, *args):
         self.connect()
 
     def on_disconnect_button_clicked(self, *args):
+        self._scheduler.user_action()
         dialog = DisconnectDialog(self._modem)
         dialog.show()
 
+    def dropped(self, redialling):
+        self._dropped_dialog = DroppedDialog(redialling)
+        self._dropped_dialog.show()
+
+    def redialling(self):
+        # Only connects that the user asked for are timed, as redials
+        # are repeated until one works.
+        self._scheduler.connecting(self._estimator.estimate())
+        self._schedule_status_check()
+
+    def recovered(self):
+        if self._dropped_dialog is not None and self._dropped_dialog.is_open:
+            self._dropped_dialog.destroy()
+        self._dropped_dialog = None
+
 
 class ConnectingDialog(Window):
 
-    def __init__(self, modem):
+    UI_TIMERS = "connecting_dialog"  # the progress bar only needs us
+
+    def __init__(self, modem, timers=None, estimate=None):
         Window.__init__(self, "connecting_dialog")
         self._modem = modem
+        if timers is None:
+            timers = TimerManager()
+        self._timers = timers
+        self._estimate = estimate
         self._progress_timeout = None
+        self._iconified = False
+        self._obscured = False
         self._modem.add_observer(self)
+        self.root_widget.add_events(gtk.gdk.VISIBILITY_NOTIFY_MASK)
+        self.root_widget.connect("window-state-event",
+                                 self._window_state_changed)
+        self.root_widget.connect("visibility-notify-event",
+                                 self._visibility_changed)
         self._start_progress_bar()
 
-    def _start_progress_bar(self):
+    def _window_state_changed(self, widget, event):
+        hidden = (gtk.gdk.WINDOW_STATE_ICONIFIED |
+                  gtk.gdk.WINDOW_STATE_WITHDRAWN)
+        self._iconified = bool(event.new_window_state & hidden)
+        self._visibility_updated()
+
+    def _visibility_changed(self, widget, event):
+        self._obscured = event.state == gtk.gdk.VISIBILITY_FULLY_OBSCURED
+        self._visibility_updated()
+
+    def _visibility_updated(self):
+        self._timers.set_visible(not (self._iconified or self._obscured),
+                                 self.UI_TIMERS)
 
-        def pulse():
-            self.progressbar1.pulse()
+    def _start_progress_bar(self):
+        started = monotonic()
+
+        def advance():
+            fraction, text = connect_progress(monotonic() - started,
+                                              self._estimate)
+            if fraction is None:
+                self.progressbar1.pulse()
+            else:
+                self.progressbar1.set_fraction(fraction)
+            self.progressbar1.set_text(text)
             return True
         
-        self._progress_timeout = gobject.timeout_add(100, pulse)
+        self._progress_timeout = self._timers.add(0.1, advance,
+                                                  ui=self.UI_TIMERS)
 
     def destroy(self):
-        gobject.source_remove(self._progress_timeout)
+        self._timers.remove(self._progress_timeout)
+        self._timers.set_visible(True, self.UI_TIMERS)
         self._modem.remove_observer(self)
         Window.destroy(self)
 
-    def update(self):
-        if self._modem.is_connected:
+    def update(self, changes):
+        if "is_connected" in changes and self._modem.is_connected:
             self.destroy()
 
     def on_cancel_button_clicked(self, *args):
@@ -315,6 +2642,28 @@ class DisconnectDialog(Window):
         self.on_cancel_button_clicked()
 
 
+class DroppedDialog(Window):
+
+    REDIALLING_TEXT = "LANdialler is trying to reconnect."
+
+    def __init__(self, redialling):
+        Window.__init__(self, "dropped_dialog")
+        self.is_open = True
+        if redialling:
+            self.label6.set_label("%s %s" % (self.label6.get_label(),
+                                             self.REDIALLING_TEXT))
+
+    def destroy(self):
+        self.is_open = False
+        Window.destroy(self)
+
+    def on_close_button_clicked(self, *args):
+        self.destroy()
+
+    def on_dropped_dialog_delete_event(self, *args):
+        self.on_close_button_clicked()
+
+
 class ErrorDialog(Dialog):
 
     def __init__(self, primary_text, secondary_text):
@@ -359,54 +2708,516 @@ class ExceptionDialog(Window):
         self.on_close_button_clicked()
 
 
+class StatsWindow(Window):
+
+    REFRESH_PERIOD = 1
+
+    def __init__(self, report, timers):
+        Window.__init__(self, "stats_window")
+        self._report = report
+        self._timers = timers
+        self._refresh()
+        self._refresh_timeout = timers.add(self.REFRESH_PERIOD,
+                                           self._refresh, ui=True)
+
+    def _refresh(self):
+        import xml.sax.saxutils
+        text = xml.sax.saxutils.escape(self._report())
+        self.stats_label.set_label("<tt>%s</tt>" % text)
+        return True
+
+    def on_stats_window_delete_event(self, *args):
+        self._timers.remove(self._refresh_timeout)
+        self.destroy()
+
+
+class CommandLine(object):
+
+    """Controls the modem from the command line, without any windows.
+
+    Each command prints the resulting status and returns an exit
+    status; OK if it succeeded (or for status(), if the server is
+    connected) and NOT_CONNECTED otherwise. The caller should treat
+    socket errors as UNREACHABLE, and mistakes in the configuration
+    file as BAD_CONFIG.
+
+    """
+
+    OK = 0
+    NOT_CONNECTED = 1
+    UNREACHABLE = 2
+    BAD_CONFIG = 3
+
+    def __init__(self, modem, scheduler, output=None):
+        self._modem = modem
+        self._scheduler = scheduler
+        if output is None:
+            output = sys.stdout
+        self._output = output
+
+    def describe(self):
+        if self._modem.is_offline:
+            return "off-line (can't contact the server)"
+        elif self._modem.is_connected:
+            seconds = self._modem.clock.seconds()
+            return "connected (users: %d, time on-line: %s)" % \
+                   (self._modem.num_users,
+                    time.strftime("%H:%M:%S", time.gmtime(int(seconds))))
+        else:
+            return "disconnected"
+
+    def update(self, changes):
+        self._output.write(self.describe() + "\n")
+        self._output.flush()
+
+    def _exit_status(self):
+        if self._modem.is_connected:
+            return self.OK
+        return self.NOT_CONNECTED
+
+    def _check_status(self):
+        self._modem.get_status(callback=self._status_checked)
+
+    def _status_checked(self):
+        if not self._modem.is_offline:
+            self._scheduler.succeeded(self._modem.is_connected,
+                                      self._modem.wants_connection)
+
+    def status(self):
+        self._modem.watch()
+        self._check_status()
+        self.update({})
+        return self._exit_status()
+
+    def connect(self, wait=False, timeout=None):
+        self._scheduler.connecting()
+        self._modem.connect()
+        self._check_status()
+        if wait:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._modem.is_connected:
+                delay = self._scheduler.next_delay()
+                if deadline is not None:
+                    if time.time() >= deadline:
+                        break
+                    delay = min(delay, deadline - time.time())
+                time.sleep(max(delay, 0))
+                self._check_status()
+        self.update({})
+        if wait:
+            return self._exit_status()
+        return self.OK
+
+    def disconnect(self, all=False):
+        self._modem.disconnect(all)
+        self.update({})
+        return self.OK
+
+    def watch(self):
+        """Print the status every time it changes, until interrupted."""
+        self._modem.watch()
+        self._modem.add_observer(self)
+        self._check_status()
+        self.update({})
+        while True:
+            time.sleep(self._scheduler.next_delay())
+            self._modem.get_status(self._watch_failed, self._status_checked)
+
+    def _watch_failed(self, exc_info):
+        self._scheduler.failed()
+
+
 class ExceptionHandler(object):
 
     def __init__(self):
         sys.excepthook = self.handler
 
     def handler(self, exc_type, exc_value, exc_tb):
-        if isinstance(exc_value, socket.error):
-            dialog = ErrorDialog(
-                "Can't contact server",
-                "The LANdialler server is not available. Please check "
-                "that it is running, and that the server address is "
-                "set correctly in the client configuration file.")
-            dialog.run()
-            gtk.main_quit()
-        else:
-            lines = traceback.format_exception(exc_type, exc_value, exc_tb)
-            exc_text = "".join(lines)
-            print exc_text,
-            dialog = ExceptionDialog(exc_text)
-            dialog.show()
+        # Failing to contact the server isn't an error (the modem goes
+        # off-line and tries again), so we only see unexpected ones.
+        import traceback
+        lines = traceback.format_exception(exc_type, exc_value, exc_tb)
+        exc_text = "".join(lines)
+        print exc_text,
+        dialog = ExceptionDialog(exc_text)
+        dialog.show()
         if gtk.main_level() < 1:
             gtk.main()
 
 
+class StartupProfiler(object):
+
+    """Records how long each phase of starting up takes.
+
+    Each call to mark() ends a phase, which is taken to have started
+    when the previous phase ended. The first phase starts at started
+    (by default, now).
+
+    """
+
+    def __init__(self, started=None):
+        if started is None:
+            started = time.time()
+        self.started = self._last_mark = started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    def report(self):
+        """Return the time taken by each phase, as a list of lines."""
+        lines = []
+        for phase, seconds in self.phases:
+            lines.append("%-12s %8.1f ms" % (phase + ":", seconds * 1000))
+        lines.append("%-12s %8.1f ms" %
+                     ("total:", (self._last_mark - self.started) * 1000))
+        return lines
+
+
+class ConfigError(Exception):
+    pass
+
+
 class App(object):
 
-    def __init__(self):
+    CALL_TIMEOUT = 10
+    SHUTDOWN_TIMEOUT = 5
+    STATS_FILE_PERIOD = 60
+    HISTORY_FLUSH_PERIOD = 300
+
+    def __init__(self, args=None):
+        self._profiler = StartupProfiler(_IMPORTS_STARTED)
+        self._profiler.mark("modules")
+        self._options = self._parse_options(args)
         self._config = ConfigParser.ConfigParser()
         self._config.read("landialler.conf")
-
-    def _connect_to_server(self):
-        hostname = self._config.get("server", "hostname")
+        self._transports = []
+        self._addresses = AddressCache()
+        self._feed = None
+        self._history_log = None
+        self._profiler.mark("config")
+
+    def _parse_options(self, args):
+        parser = optparse.OptionParser(usage="%prog [options]",
+                                       version="%prog " + __version__)
+        parser.add_option("--stats", action="store_true", default=False,
+                          help="print performance statistics on exit")
+        parser.add_option("--stats-file", metavar="FILE",
+                          help="write performance statistics to FILE "
+                          "every minute")
+        parser.add_option("--stats-window", action="store_true",
+                          default=False,
+                          help="show performance statistics in a window")
+        parser.add_option("--profile-startup", action="store_true",
+                          default=False,
+                          help="print the time taken by each phase of "
+                          "starting up")
+        group = optparse.OptionGroup(
+            parser, "Command line interface",
+            "These options control the connection without opening any "
+            "windows.")
+        group.add_option("--status", action="store_true", default=False,
+                         help="print the status (exits with 0 if "
+                         "connected, 1 if not)")
+        group.add_option("--connect", action="store_true", default=False,
+                         help="ask the server to connect")
+        group.add_option("--wait", action="store_true", default=False,
+                         help="with --connect, wait until connected")
+        group.add_option("--timeout", type="float", metavar="SECS",
+                         help="with --wait, give up after SECS seconds")
+        group.add_option("--disconnect", action="store_true", default=False,
+                         help="tell the server we're finished with it")
+        group.add_option("--all", action="store_true", default=False,
+                         help="with --disconnect, disconnect everybody")
+        group.add_option("--watch", action="store_true", default=False,
+                         help="print the status whenever it changes")
+        parser.add_option_group(group)
+        options, args = parser.parse_args(args)
+        return options
+
+    def _is_headless(self):
+        options = self._options
+        return options.status or options.connect or options.disconnect or \
+               options.watch
+
+    def run_command(self):
+        """Carry out the command line options, returning an exit status."""
+        if self._options.watch:
+            breaker = CircuitBreaker()
+        else:
+            breaker = None
+        modem = RemoteModem(self._connect_to_server(), breaker=breaker)
+        command = CommandLine(modem, self._create_scheduler())
+        try:
+            if self._options.disconnect:
+                return command.disconnect(self._options.all)
+            elif self._options.connect:
+                return command.connect(self._options.wait,
+                                       self._options.timeout)
+            elif self._options.watch:
+                return command.watch()
+            else:
+                return command.status()
+        except KeyboardInterrupt:
+            return command.OK
+        except (socket.error, xmlrpclib.Error), e:
+            print >> sys.stderr, "landialler: can't contact the server " \
+                  "(%s)" % e
+            return command.UNREACHABLE
+
+    def _server_hosts(self):
+        """Return the "host:port" of each server in the configuration."""
         port = self._config.get("server", "port")
-        return xmlrpclib.ServerProxy("http://%s:%s/" % (hostname, port))
-        
+        hosts = []
+        for host in self._config.get("server", "hostname").split(","):
+            host = host.strip()
+            if ":" not in host.split("]")[-1]:
+                host = "%s:%s" % (host, port)
+            hosts.append(host)
+        return hosts
+
+    def _connect_to_server(self, timeout=None):
+        if timeout is None:
+            timeout = self._call_timeout()
+        hosts = self._server_hosts()
+        if len(hosts) == 1:
+            transport = KeepAliveTransport(timeout, self._addresses)
+            self._transports.append(transport)
+            return CompactStatusProxy(
+                xmlrpclib.ServerProxy("http://%s/" % hosts[0], transport),
+                hosts[0], transport)
+        endpoints = []
+        for host in hosts:
+            transport = KeepAliveTransport(timeout, self._addresses)
+            self._transports.append(transport)
+            endpoints.append(Endpoint(host, transport))
+        return FailoverServerProxy(endpoints, timeout, self._addresses)
+
+    def _create_history(self, modem, timers):
+        if not self._config.has_section("history"):
+            return None
+        if self._config.has_option("history", "log"):
+            max_bytes = 1000000
+            if self._config.has_option("history", "log_size"):
+                max_bytes = self._config.getint("history", "log_size")
+            path = os.path.expanduser(self._config.get("history", "log"))
+            self._history_log = HistoryLog(path, max_bytes)
+            timers.add(App.HISTORY_FLUSH_PERIOD, self._history_log.flush)
+        return StatusHistory(modem, log=self._history_log)
+
+    def _create_estimator(self):
+        path = None
+        if self._config.has_option("history", "connect_times"):
+            path = os.path.expanduser(
+                self._config.get("history", "connect_times"))
+        return ConnectTimeEstimator(path)
+
+    def _graphed_history(self, history):
+        if self._config.has_option("history", "graph") and \
+               not self._config.getboolean("history", "graph"):
+            return None
+        return history
+
+    def _graph_span(self):
+        if self._config.has_option("history", "hours"):
+            return self._config.getfloat("history", "hours") * 60 * 60
+        return 24 * 60 * 60
+
+    def _get_options(self, section, getters):
+        """Read the options in a section of the configuration file.
+
+        getters maps the name of each option that the section may
+        contain to the name of the ConfigParser method that reads it
+        (e.g. "getfloat"). Returns a dictionary of the values, raising
+        ConfigError if an option is unknown or its value is invalid.
+
+        """
+        options = {}
+        if not self._config.has_section(section):
+            return options
+        for name in self._config.options(section):
+            if name not in getters:
+                known = getters.keys()
+                known.sort()
+                raise ConfigError("unknown option %s in [%s] (expected "
+                                  "one of %s)" % (name, section,
+                                                  ", ".join(known)))
+            try:
+                options[name] = getattr(self._config, getters[name])(
+                    section, name)
+            except ValueError:
+                raise ConfigError("bad value for %s in [%s]: %s" %
+                                  (name, section,
+                                   self._config.get(section, name)))
+        return options
+
+    def _supervisor_options(self):
+        return self._get_options("reconnect", {"redial": "getboolean",
+                                               "min_delay": "getfloat",
+                                               "max_delay": "getfloat"})
+
+    def _create_supervisor(self, modem, timers, window):
+        return ReconnectSupervisor(modem, timers, window,
+                                   **self._supervisor_options())
+
+    def _check_config(self):
+        """Raise ConfigError if the configuration file has a mistake."""
+        self._create_scheduler()
+        self._supervisor_options()
+
+    def _create_status_feed(self, modem, subscription):
+        if not LocalStatusFeed.is_supported() or \
+               not self._config.has_option("sharing", "socket"):
+            return None
+        return LocalStatusFeed(self._config.get("sharing", "socket"), modem,
+                               gobject.idle_add, subscription)
+
+    def _call_timeout(self):
+        if self._config.has_option("server", "timeout"):
+            return self._config.getfloat("server", "timeout")
+        return App.CALL_TIMEOUT
+
+    def _create_scheduler(self):
+        # Options for policies other than the chosen one are ignored,
+        # so that the policy can be changed without removing them.
+        getters = {"policy": "get"}
+        for scheduler in POLL_SCHEDULERS.values():
+            for name in _keyword_args(scheduler):
+                getters[name] = "getfloat"
+        options = self._get_options("polling", getters)
+        policy = options.pop("policy", "adaptive").strip().lower()
+        if policy not in POLL_SCHEDULERS:
+            policies = POLL_SCHEDULERS.keys()
+            policies.sort()
+            raise ConfigError("unknown policy %s in [polling] (expected "
+                              "one of %s)" % (policy, ", ".join(policies)))
+        scheduler = POLL_SCHEDULERS[policy]
+        accepted = {}
+        for name in _keyword_args(scheduler):
+            if name in options:
+                accepted[name] = options[name]
+        return scheduler(**accepted)
+
+    def _stats_report(self, modem, timers, supervisor, history):
+        lines = modem.stats.report() + supervisor.report()
+        if history is not None:
+            lines.append("peak users in the last day: %d" %
+                         history.peak_users(time.time() - 24 * 60 * 60))
+        lines.append("calls shared: %d, avoided: %d" %
+                     (modem.calls_shared, modem.calls_avoided))
+        calls = connections = sent = received = 0
+        for transport in self._transports:
+            calls += transport.calls_made
+            connections += transport.connections_opened
+            sent += transport.bytes_sent
+            received += transport.bytes_received
+        lines.append("server calls: %d over %d connections" %
+                     (calls, connections))
+        lines.append("bytes sent: %d, received: %d" % (sent, received))
+        lines.append("timer wakeups: %d (%.2f per second)" %
+                     (timers.wakeups, timers.wakeups_per_second()))
+        return "\n".join(lines)
+
+    def _write_stats_file(self, report):
+        stats_file = file(self._options.stats_file, "w")
+        try:
+            stats_file.write(report() + "\n")
+        finally:
+            stats_file.close()
+        return True
+
+    def _start(self, modem, window):
+        # Called once the main window has been drawn for the first time.
+        self._profiler.mark("first paint")
+        subscription = StatusSubscription(
+            self._connect_to_server(StatusSubscription.WAIT_TIMEOUT +
+                                    self._call_timeout()),
+            modem, gobject.idle_add)
+        self._feed = self._create_status_feed(modem, subscription)
+        if self._feed is None:
+            subscription.start()
+        else:
+            modem.status_feed = self._feed
+            self._feed.start()
+
+        def detected():
+            # Connecting once we know what the server supports lets
+            # the connect be batched with a status check.
+            window.connect()
+            if self._options.profile_startup:
+                # Replies come back in order, so this is after connect's.
+                modem.get_status(self._first_reply_failed,
+                                 self._first_reply_received)
+
+        modem.detect_capabilities(detected)
+        WidgetWrapper.glade.preload(["connecting_dialog",
+                                     "disconnect_dialog",
+                                     "dropped_dialog"])
+
+    def _first_reply_received(self):
+        self._profiler.mark("first RPC")
+        print "\n".join(self._profiler.report())
+
+    def _first_reply_failed(self, exc_info):
+        # An unreachable server is worth profiling too.
+        self._profiler.mark("failed RPC")
+        print "\n".join(self._profiler.report())
+
     def main(self):
+        try:
+            self._check_config()
+        except ConfigError, e:
+            print >> sys.stderr, "landialler: error in landialler.conf: " \
+                  "%s" % e
+            return CommandLine.BAD_CONFIG
+        if self._is_headless():
+            return self.run_command()
+        self._addresses.prefetch(self._server_hosts())
+        import_gtk()
+        self._profiler.mark("imports")
         try:
             ExceptionHandler()
+            gobject.threads_init()
             server = self._connect_to_server()
-            modem = RemoteModem(server)
-            window = MainWindow(modem)
+            modem = RemoteModem(server, RpcWorker(gobject.idle_add),
+                                breaker=CircuitBreaker())
+            timers = TimerManager()
+            history = self._create_history(modem, timers)
+            window = MainWindow(modem, self._create_scheduler(), timers,
+                                self._graphed_history(history),
+                                self._graph_span(), self._create_estimator())
+            self._profiler.mark("glade parse")
             window.show()
+            # Idle callbacks run after GTK has finished redrawing.
+            gobject.idle_add(_call_once, self._start, modem, window)
+            supervisor = self._create_supervisor(modem, timers, window)
+            report = lambda: self._stats_report(modem, timers, supervisor,
+                                                history)
+            if self._options.stats_window:
+                StatsWindow(report, timers).show()
+            if self._options.stats_file:
+                timers.add(App.STATS_FILE_PERIOD,
+                           lambda: self._write_stats_file(report))
             gtk.main()
+            if self._feed is not None:
+                self._feed.stop()
+            if self._history_log is not None:
+                self._history_log.flush()
+            modem.close(App.SHUTDOWN_TIMEOUT)
+            if self._options.stats_file:
+                self._write_stats_file(report)
+            if self._options.stats:
+                print report()
         except KeyboardInterrupt:
             modem.disconnect()
+            modem.close(App.SHUTDOWN_TIMEOUT)
             gtk.main_quit()
 
 
 if __name__ == "__main__":
     app = App()
-    app.main()
+    sys.exit(app.main())
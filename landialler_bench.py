@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# landialler_bench.py - performance benchmarks for the landialler client
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""measure the performance of the landialler client
+
+The benchmarks run against a fakelandiallerd server on the loopback
+interface, started in the same process, so no network (or modem) is
+needed. The server can be made to respond slowly or unreliably.
+
+Each result is printed on a line of its own, as three tab separated
+fields (the name of the measurement, its value and its unit), so that
+results from different releases can easily be compared.
+
+The benchmarks that create windows are skipped if there is no display.
+
+Usage: landialler_bench.py [options]
+
+  -n count, --count=count       number of iterations (default 1000)
+  -l secs, --latency=secs       server delay before each reply
+  -j secs, --jitter=secs        maximum extra random server delay
+  -f rate, --failure-rate=rate  proportion of server calls that fail
+  -o file, --output=file        write results to file (default stdout)
+
+"""
+
+
+import optparse
+import struct
+import sys
+import timeit
+import xmlrpclib
+
+import fakelandiallerd
+import landialler
+
+
+timer = timeit.default_timer
+
+
+class Results(object):
+
+    def __init__(self, output):
+        self._output = output
+
+    def add(self, name, value, unit):
+        self._output.write("%s\t%.6g\t%s\n" % (name, value, unit))
+        self._output.flush()
+
+    def add_times(self, name, times):
+        """Record the mean, median and 95th percentile of times."""
+        times = times[:]
+        times.sort()
+        mean = sum(times) / len(times)
+        self.add(name + ".mean", mean * 1000, "ms")
+        self.add(name + ".median", times[len(times) / 2] * 1000, "ms")
+        self.add(name + ".p95", times[int(len(times) * 0.95)] * 1000, "ms")
+
+    def add_percentiles(self, name, times, percentiles):
+        times = times[:]
+        times.sort()
+        for percentile in percentiles:
+            index = min(int(len(times) * percentile / 100.0), len(times) - 1)
+            self.add("%s.p%s" % (name, percentile), times[index] * 1000, "ms")
+
+
+class Observer(object):
+
+    def update(self):
+        pass
+
+
+def ignore_faults(func):
+    try:
+        func()
+    except xmlrpclib.Fault:
+        pass
+
+
+def bench_rpc(results, host, count):
+    url = "http://%s/" % host
+    compact = landialler.KeepAliveTransport()
+    for name, transport, proxy in [
+        ("keepalive", landialler.KeepAliveTransport(), None),
+        ("standard", xmlrpclib.Transport(), None),
+        ("compact", compact, landialler.CompactStatusProxy(
+            xmlrpclib.ServerProxy(url, compact), host, compact))]:
+        if proxy is None:
+            proxy = xmlrpclib.ServerProxy(url, transport)
+        modem = landialler.RemoteModem(proxy)
+        ignore_faults(modem.connect)
+        if hasattr(transport, "bytes_received"):
+            sent = transport.bytes_sent
+            received = transport.bytes_received
+        times = []
+        errors = 0
+        started = timer()
+        for i in range(count):
+            before = timer()
+            try:
+                modem.get_status()
+            except xmlrpclib.Error:  # Fault, or ProtocolError if compact
+                errors += 1
+            times.append(timer() - before)
+        elapsed = timer() - started
+        if hasattr(transport, "bytes_received"):
+            results.add("rpc.%s.bytes_per_poll" % name,
+                        float(transport.bytes_sent - sent +
+                              transport.bytes_received - received) / count,
+                        "bytes")
+        ignore_faults(modem.disconnect)
+        if hasattr(transport, "close"):
+            transport.close()
+        results.add_times("rpc.%s.get_status" % name, times)
+        results.add("rpc.%s.polls_per_second" % name, count / elapsed, "/s")
+        results.add("rpc.%s.errors" % name, errors, "calls")
+        if name != "standard":
+            results.add("rpc.%s.connections" % name,
+                        transport.connections_opened, "connections")
+
+
+def bench_marshalling(results, count):
+    """Compare the cost of encoding and decoding a status reply."""
+    status = (2, True, 12345)
+    frame = landialler.CompactStatusProxy.STATUS_FRAME
+    for name, encode, decode in [
+        ("xmlrpc",
+         lambda: xmlrpclib.dumps((status, ), methodresponse=1),
+         lambda data: xmlrpclib.loads(data)[0][0]),
+        ("compact",
+         lambda: struct.pack(frame, *status),
+         lambda data: struct.unpack(frame, data))]:
+        data = encode()
+        started = timer()
+        for i in range(count):
+            decode(encode())
+        elapsed = timer() - started
+        results.add("marshal.%s.bytes" % name, len(data), "bytes")
+        results.add("marshal.%s.time" % name, elapsed / count * 1000000, "us")
+
+
+def bench_notify(results, count):
+    for num_observers in [1, 10, 100]:
+        observable = landialler.Observable()
+        observers = []
+        for i in range(num_observers):
+            observers.append(Observer())
+            observable.add_observer(observers[-1])
+        started = timer()
+        for i in range(count):
+            observable.notify_observers()
+        elapsed = timer() - started
+        results.add("notify.observers_%d" % num_observers,
+                    elapsed / count * 1000000, "us")
+
+
+def have_display():
+    try:
+        landialler.import_gtk()
+        return landialler.gtk.gdk.display_get_default() is not None
+    except (ImportError, AttributeError, RuntimeError):
+        return False
+
+
+def bench_windows(results, url, count):
+    modem = landialler.RemoteModem(xmlrpclib.ServerProxy(
+        url, landialler.KeepAliveTransport()))
+    timers = landialler.TimerManager()
+    window = landialler.MainWindow(modem, timers=timers)
+    modem.is_connected = True
+    modem.num_users = 1
+    modem.clock.sync(0)
+    window.update({"is_connected": None})
+    started = timer()
+    for i in range(count):
+        window._update_timer()
+    elapsed = timer() - started
+    results.add("ui.update_timer", elapsed / count * 1000000, "us")
+
+    for name, create in [
+        ("connecting", lambda: landialler.ConnectingDialog(modem, timers)),
+        ("disconnect", lambda: landialler.DisconnectDialog(modem)),
+        ("error", lambda: landialler.ErrorDialog("primary", "secondary"))]:
+        times = []
+        for i in range(min(count, 100)):
+            before = timer()
+            dialog = create()
+            times.append(timer() - before)
+            dialog.destroy()
+        results.add_times("ui.dialog.%s" % name, times)
+    window.destroy()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--count", type="int", default=1000,
+                      help="number of iterations")
+    parser.add_option("-l", "--latency", type="float", default=0,
+                      help="seconds the server waits before each reply")
+    parser.add_option("-j", "--jitter", type="float", default=0,
+                      help="maximum extra random server delay, in seconds")
+    parser.add_option("-f", "--failure-rate", type="float", default=0,
+                      help="proportion of server calls that fail")
+    parser.add_option("-o", "--output", help="write results to file")
+    options, args = parser.parse_args()
+
+    output = sys.stdout
+    if options.output:
+        output = file(options.output, "w")
+    results = Results(output)
+    server = fakelandiallerd.Server(("127.0.0.1", 0),
+                                    fakelandiallerd.FakeModem(dial_time=0),
+                                    options.latency, options.jitter,
+                                    options.failure_rate)
+    server.start()
+    host = "127.0.0.1:%s" % server.server_address[1]
+
+    bench_rpc(results, host, options.count)
+    bench_marshalling(results, options.count)
+    bench_notify(results, options.count)
+    if have_display():
+        bench_windows(results, "http://%s/" % host, options.count)
+
+
+if __name__ == "__main__":
+    main()
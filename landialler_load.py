@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# landialler_load.py - simulate many landialler clients
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""put a landialler server under load from many simulated clients
+
+Each simulated client runs on its own thread, with its own RemoteModem
+and its own connection to the server, and registers with a client ID
+of its own. Clients follow one of these scenarios:
+
+  poll    connect once, then check the status every interval seconds
+  mixed   connect, check the status a few times, then disconnect
+          (occasionally hanging up for everyone), pause and start again
+
+When no server is given a fakelandiallerd server is started in the
+same process. Results (throughput, latency percentiles for each type of
+call and error rates) are printed in the same format as those of
+landialler_bench.py. Calls that get no reply within the timeout count
+as errors, so an overloaded server doesn't stop the run.
+
+Usage: landialler_load.py [options] [hostname:port]
+
+  -c num, --clients=num         number of clients (default 100)
+  -d secs, --duration=secs      how long to run for (default 30)
+  -i secs, --interval=secs      time between status checks (default 2)
+  -t secs, --timeout=secs       time to wait for each reply (default 10)
+  -s name, --scenario=name      "poll" or "mixed" (default mixed)
+  -l secs, --latency=secs       delay before each reply (local server)
+  -f rate, --failure-rate=rate  proportion of failed calls (local server)
+
+"""
+
+
+import optparse
+import random
+import socket
+import sys
+import threading
+import time
+import xmlrpclib
+
+import fakelandiallerd
+import landialler
+import landialler_bench
+
+
+class Recorder(object):
+
+    """Collects the time taken by each call, from all clients."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times = {}  # name of call -> list of times
+        self.errors = {}  # name of call -> number of failures
+
+    def call(self, name, func, *args):
+        started = time.time()
+        try:
+            func(*args)
+        except (socket.error, xmlrpclib.Error):
+            failed = True
+        else:
+            failed = False
+        elapsed = time.time() - started
+        self._lock.acquire()
+        try:
+            self.times.setdefault(name, []).append(elapsed)
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        finally:
+            self._lock.release()
+        return not failed
+
+
+class Client(threading.Thread):
+
+    HANG_UP_PROBABILITY = 0.05
+
+    def __init__(self, number, url, recorder, options, deadline):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._transport = landialler.KeepAliveTransport(options.timeout)
+        self._modem = landialler.RemoteModem(
+            xmlrpclib.ServerProxy(url, self._transport),
+            client_id="load%d@%s" % (number, socket.gethostname()))
+        self._recorder = recorder
+        self._options = options
+        self._deadline = deadline
+
+    def _sleep(self, seconds):
+        time.sleep(max(min(seconds, self._deadline - time.time()), 0))
+
+    def _poll(self, times=None):
+        while time.time() < self._deadline and times != 0:
+            self._sleep(self._options.interval)
+            self._recorder.call("get_status", self._modem.get_status)
+            if times is not None:
+                times -= 1
+
+    def run(self):
+        self._sleep(random.uniform(0, self._options.interval))
+        recorder = self._recorder
+        while time.time() < self._deadline:
+            recorder.call("connect", self._modem.connect)
+            if self._options.scenario == "poll":
+                self._poll()
+            else:
+                self._poll(random.randint(1, 10))
+                if random.random() < self.HANG_UP_PROBABILITY:
+                    recorder.call("hang_up", self._modem.disconnect, True)
+                else:
+                    recorder.call("disconnect", self._modem.disconnect)
+                self._sleep(random.uniform(0, self._options.interval * 5))
+        if self._options.scenario == "poll":
+            recorder.call("disconnect", self._modem.disconnect)
+        self._transport.close()
+
+
+def report(results, recorder, elapsed):
+    total_calls = total_errors = 0
+    names = recorder.times.keys()
+    names.sort()
+    for name in names:
+        times = recorder.times[name]
+        errors = recorder.errors.get(name, 0)
+        total_calls += len(times)
+        total_errors += errors
+        results.add("load.%s.calls" % name, len(times), "calls")
+        results.add("load.%s.error_rate" % name,
+                    float(errors) / len(times) * 100, "%")
+        results.add_percentiles("load.%s" % name, times, [50, 90, 99, 100])
+    results.add("load.calls", total_calls, "calls")
+    results.add("load.throughput", total_calls / elapsed, "/s")
+    if total_calls:
+        results.add("load.error_rate",
+                    float(total_errors) / total_calls * 100, "%")
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [hostname:port]")
+    parser.add_option("-c", "--clients", type="int", default=100,
+                      help="number of simulated clients")
+    parser.add_option("-d", "--duration", type="float", default=30,
+                      help="seconds to run for")
+    parser.add_option("-i", "--interval", type="float", default=2,
+                      help="seconds between status checks")
+    parser.add_option("-t", "--timeout", type="float", default=10,
+                      help="seconds to wait for each reply")
+    parser.add_option("-s", "--scenario", choices=["poll", "mixed"],
+                      default="mixed", help="what the clients do")
+    parser.add_option("-l", "--latency", type="float", default=0,
+                      help="reply delay of the local server, in seconds")
+    parser.add_option("-f", "--failure-rate", type="float", default=0,
+                      help="proportion of calls the local server fails")
+    options, args = parser.parse_args()
+
+    if args:
+        url = "http://%s/" % args[0]
+    else:
+        server = fakelandiallerd.Server(
+            ("127.0.0.1", 0), fakelandiallerd.FakeModem(dial_time=1),
+            latency=options.latency, failure_rate=options.failure_rate)
+        server.start()
+        url = "http://127.0.0.1:%s/" % server.server_address[1]
+
+    recorder = Recorder()
+    started = time.time()
+    deadline = started + options.duration
+    clients = []
+    for i in range(options.clients):
+        clients.append(Client(i, url, recorder, options, deadline))
+        clients[-1].start()
+    for client in clients:
+        # Each client makes at most two calls after the deadline.
+        client.join(max(deadline - time.time(), 0) + options.timeout * 2 + 1)
+    report(landialler_bench.Results(sys.stdout), recorder,
+           time.time() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,20 @@
 # $Id: landialler_test.py,v 1.6 2004/10/03 10:24:43 ashtong Exp $
 
 
+import ConfigParser
 import os
+import shutil
 import socket
+import SimpleXMLRPCServer
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import xmlrpclib
 
+import fakelandiallerd
 import landialler
 import mock
 
@@ -30,6 +39,172 @@ class ObservableTest(unittest.TestCase):
         self.assertEqual(len(observer.getNamedCalls('update')), 0)
 
 
+    def test_changes(self):
+        """Check observers can be told what has changed"""
+        class Observer:
+            def update(self, changes):
+                self.changes = changes
+        observable = landialler.Observable()
+        observer = Observer()
+        observable.add_observer(observer)
+        observable.notify_observers({"is_connected": None})
+        self.assertEqual(observer.changes, {"is_connected": None})
+
+    def test_weak_reference(self):
+        """Check observers that have been thrown away aren't notified"""
+        updates = []
+        class Observer:
+            def update(self):
+                updates.append(self)
+        observable = landialler.Observable()
+        observable.add_observer(Observer())
+        observable.notify_observers()
+        self.assertEqual(updates, [])
+
+
+def dispatch_now(func, *args):
+    func(*args)
+
+
+class RpcWorkerTest(unittest.TestCase):
+
+    def test_callback(self):
+        """Check worker passes results of remote calls to callback"""
+        results = []
+        worker = landialler.RpcWorker(dispatch_now)
+        worker.call(lambda x: x * 2, (21, ), results.append, None)
+        worker.stop()
+        self.assertEqual(results, [42])
+
+    def test_errback(self):
+        """Check worker passes exceptions raised by remote calls to errback"""
+        errors = []
+        def fail():
+            raise socket.error
+        worker = landialler.RpcWorker(dispatch_now)
+        worker.call(fail, (), None, errors.append)
+        worker.stop()
+        self.assertEqual(errors[0][0], socket.error)
+
+    def test_cancel(self):
+        """Check cancelled calls aren't made"""
+        calls = []
+        started = threading.Event()
+        carry_on = threading.Event()
+        def block():
+            started.set()
+            carry_on.wait()
+        worker = landialler.RpcWorker(dispatch_now)
+        worker.call(block, (), calls.append, None)
+        started.wait()
+        call = worker.call(lambda: "cancelled", (), calls.append, None)
+        call.cancel()
+        carry_on.set()
+        worker.stop()
+        self.assertEqual(calls, [None])
+
+    def test_status_via_worker(self):
+        """Check modem status is updated when worker delivers result"""
+        server = mock.Mock({'get_status': (2, True, 23)})
+        worker = landialler.RpcWorker(dispatch_now)
+        modem = landialler.RemoteModem(server, worker)
+        observer = mock.Mock()
+        modem.add_observer(observer)
+        modem.connect()
+        modem.get_status()
+        modem.close()
+        self.assertEqual(modem.is_connected, True)
+        self.assertEqual(len(observer.getNamedCalls('update')), 1)
+
+
+class KeepAliveHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ("127.0.0.1", 0), KeepAliveHandler, logRequests=False)
+        self.server.register_function(lambda x: x, "echo")
+        self.stalled = []
+        def stall():
+            self.stalled.append(None)
+            time.sleep(1)
+            return True
+        self.server.register_function(stall, "stall")
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse_connection(self):
+        """Check transport makes several calls over one connection"""
+        transport = landialler.KeepAliveTransport()
+        proxy = xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % self.server.server_address[1],
+            transport)
+        for i in range(3):
+            self.assertEqual(proxy.echo(i), i)
+        transport.close()
+        self.assertEqual(transport.calls_made, 3)
+        self.assertEqual(transport.connections_opened, 1)
+
+    def test_reconnect(self):
+        """Check transport reconnects when server closes connection"""
+        transport = landialler.KeepAliveTransport()
+        proxy = xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % self.server.server_address[1],
+            transport)
+        proxy.echo(1)
+        transport._connection.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(proxy.echo(2), 2)
+        transport.close()
+        self.assertEqual(transport.connections_opened, 2)
+
+    def test_closed_after_partial_response(self):
+        """Check a connection isn't reused if a reply is cut short"""
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        def serve():
+            sock = listener.accept()[0]
+            sock.recv(65536)
+            sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n"
+                         "<?xml")
+            time.sleep(2)
+            sock.close()
+        thread = threading.Thread(target=serve)
+        thread.setDaemon(True)
+        thread.start()
+        transport = landialler.KeepAliveTransport(timeout=0.5)
+        proxy = xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % listener.getsockname()[1], transport)
+        self.assertRaises(socket.timeout, proxy.echo, 1)
+        self.assertEqual(transport._connection, None)
+        listener.close()
+
+    def test_no_resend_after_timeout(self):
+        """Check a request isn't sent again if the server is too slow"""
+        transport = landialler.KeepAliveTransport(timeout=0.5)
+        proxy = xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % self.server.server_address[1],
+            transport)
+        proxy.echo(1)
+        started = time.time()
+        self.assertRaises(socket.timeout, proxy.stall)
+        self.assert_(time.time() - started < 1)
+        transport.close()
+        self.assertEqual(len(self.stalled), 1)
+
+
 class RemoteModemTest(unittest.TestCase):
 
     def test_client_id(self):
@@ -56,6 +231,40 @@ class RemoteModemTest(unittest.TestCase):
         user = os.environ['USER']
         self.assertEqual(modem.client_id, '%s@%s' % (user, ip))
 
+    def test_client_id_cached(self):
+        """Check client ID is only looked up once"""
+        modem = landialler.RemoteModem(mock.Mock())
+        client_id = modem.client_id
+        self.assertEqual(modem.client_id, client_id)
+        self.assertEqual(modem.client_id_lookups_avoided, 1)
+
+    def test_client_id_follows_hostname(self):
+        """Check client ID is looked up again if host name changes"""
+        modem = landialler.RemoteModem(mock.Mock())
+        modem.client_id
+        gethostname = socket.gethostname
+        try:
+            socket.gethostname = lambda: "localhost"
+            self.assert_(modem.client_id.endswith("127.0.0.1"))
+        finally:
+            socket.gethostname = gethostname
+        self.assertEqual(modem.client_id_lookups_avoided, 0)
+
+    def test_client_id_forgotten_on_error(self):
+        """Check client ID is looked up again after a socket error"""
+        class Server:
+            def connect(self, client_id):
+                raise socket.error
+        modem = landialler.RemoteModem(Server())
+        self.assertRaises(socket.error, modem.connect)
+        modem.client_id
+        self.assertEqual(modem.client_id_lookups_avoided, 0)
+
+    def test_fixed_client_id(self):
+        """Check client ID can be chosen by the caller"""
+        modem = landialler.RemoteModem(mock.Mock(), client_id="test@host")
+        self.assertEqual(modem.client_id, "test@host")
+
     def test_connect(self):
         """Check remote calls to connect() method"""
         server = mock.Mock()
@@ -119,6 +328,73 @@ class RemoteModemTest(unittest.TestCase):
         modem.get_status()
         self.assertEqual(len(server.getNamedCalls('get_status')), 1)
 
+    def test_unchanged_status_not_notified(self):
+        """Check observers aren't notified if the status hasn't changed"""
+        server = mock.Mock({'get_status': (2, True, 23)})
+        modem = landialler.RemoteModem(server)
+        observer = mock.Mock()
+        modem.add_observer(observer)
+        modem.connect()
+        modem.get_status()
+        modem.get_status()
+        self.assertEqual(len(observer.getNamedCalls('update')), 1)
+
+    def test_time_online_discontinuity(self):
+        """Check time on-line only changes if it jumps"""
+        changes = []
+        class Observer:
+            def update(self, changed):
+                changes.append(changed)
+        now = [1000.0]
+        modem = landialler.RemoteModem(mock.Mock())
+        modem.clock = landialler.OnlineClock(clock=lambda: now[0])
+        observer = Observer()
+        modem.add_observer(observer)
+        modem.connect()
+        modem.status_pushed((1, True, 100))
+        now[0] += 10
+        modem.status_pushed((1, True, 110))
+        modem.status_pushed((1, True, 5))
+        self.assertEqual(changes, [
+            {"is_subscribed": None},
+            {"num_users": None, "is_connected": None, "seconds_online": None},
+            {"seconds_online": None}])
+        self.assertEqual(modem.seconds_online, 5)
+
+    def test_clock_set_on_connecting(self):
+        """Check the clock is set by the first connected status"""
+        now = [1000.0]
+        modem = landialler.RemoteModem(mock.Mock())
+        modem.clock = landialler.OnlineClock(clock=lambda: now[0])
+        modem.connect()
+        modem.status_pushed((0, False, 0))
+        self.failIf(modem.clock.is_set)
+        now[0] += 1
+        modem.status_pushed((1, True, 0))
+        self.assertEqual(modem.clock.seconds(), 0)
+
+    def test_subscriber_polls_while_connecting(self):
+        """Check a subscriber checks the status itself while connecting"""
+        server = mock.Mock({'get_status': (1, False, 0)})
+        modem = landialler.RemoteModem(server)
+        modem.status_pushed((0, False, 0))
+        modem.connect()
+        modem.get_status()
+        self.assertEqual(len(server.getNamedCalls('get_status')), 1)
+        modem.status_pushed((1, True, 0))
+        modem.get_status()
+        self.assertEqual(len(server.getNamedCalls('get_status')), 1)
+
+    def test_status_checked_callback(self):
+        """Check callback is called whether or not the status changes"""
+        server = mock.Mock({'get_status': (2, True, 23)})
+        modem = landialler.RemoteModem(server)
+        checked = []
+        modem.get_status(callback=lambda: checked.append(True))
+        modem.connect()
+        modem.get_status(callback=lambda: checked.append(True))
+        self.assertEqual(len(checked), 2)
+
     def test_hang_up_sets_disconnected(self):
         """Check that modem doesn't appear to be connected after hang up"""
         server = mock.Mock({'get_status': (1, True, 23)})
@@ -130,5 +406,1172 @@ class RemoteModemTest(unittest.TestCase):
         self.assertEqual(modem.is_connected, False)
         
 
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class StatusSubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakelandiallerd.Server(
+            ("127.0.0.1", 0), fakelandiallerd.FakeModem(dial_time=0))
+        self.server.start()
+        self.url = "http://127.0.0.1:%s/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_status_pushed(self):
+        """Check subscription tells modem when it has connected"""
+        modem = landialler.RemoteModem(xmlrpclib.ServerProxy(self.url))
+        subscription = landialler.StatusSubscription(
+            xmlrpclib.ServerProxy(self.url), modem, dispatch_now)
+        subscription.start()
+        modem.connect()
+        self.assert_(wait_until(lambda: modem.is_connected))
+        self.assertEqual(modem.is_subscribed, True)
+        self.assertEqual(modem.num_users, 1)
+        subscription.stop()
+
+    def test_fall_back_to_polling(self):
+        """Check modem polls if server doesn't support subscriptions"""
+        class Server:
+            class system:
+                def listMethods():
+                    return ["connect", "disconnect", "get_status"]
+                listMethods = staticmethod(listMethods)
+        modem = landialler.RemoteModem(mock.Mock())
+        modem.is_subscribed = True
+        subscription = landialler.StatusSubscription(Server(), modem,
+                                                     dispatch_now)
+        subscription.start()
+        self.assert_(wait_until(lambda: not modem.is_subscribed))
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakelandiallerd.Server(("127.0.0.1", 0))
+        self.server.start()
+        self.transport = landialler.KeepAliveTransport()
+        self.proxy = xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % self.server.server_address[1],
+            self.transport)
+        self.modem = landialler.RemoteModem(self.proxy)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connect_reads_status(self):
+        """Check connecting reads status in the same request"""
+        self.modem.detect_capabilities()
+        self.assert_(self.modem.supports("system.multicall"))
+        self.modem.connect()
+        self.assertEqual(self.transport.calls_made, 2)
+        self.assertEqual(self.modem.num_users, 1)
+
+    def test_connect_once_capabilities_known(self):
+        """Check a connect made when capabilities are known is batched"""
+        worker = landialler.RpcWorker(dispatch_now)
+        modem = landialler.RemoteModem(self.proxy, worker)
+        modem.detect_capabilities(modem.connect)
+        self.assert_(wait_until(lambda: modem.num_users == 1))
+        modem.close(5)
+        self.assertEqual(self.transport.calls_made, 2)
+
+    def test_capabilities_unknown(self):
+        """Check the callback is called if capabilities can't be found"""
+        modem = landialler.RemoteModem(xmlrpclib.ServerProxy(
+            "http://127.0.0.1:%s/" % unused_port()))
+        called = []
+        modem.detect_capabilities(lambda: called.append(None))
+        self.assertEqual(called, [None])
+        self.failIf(modem.supports("system.multicall"))
+
+    def test_batch_without_multicall(self):
+        """Check batched calls are made one by one if necessary"""
+        results = []
+        self.modem._batch([("get_status", ("a", )), ("connect", ("a", ))],
+                          results.append)
+        self.assertEqual(results[0][0], [0, False, 0])
+        self.assertEqual(self.transport.calls_made, 2)
+
+
+class StatusDisplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = mock.Mock()
+        for name in ["status_label", "details_label", "root_widget",
+                     "connect_button", "disconnect_button"]:
+            setattr(self.window, name, mock.Mock())
+        self.display = landialler.StatusDisplay(self.window)
+
+    def test_show_connected(self):
+        """Check connection details are displayed"""
+        self.display.show_connected(2, 61)
+        call = self.window.details_label.getNamedCalls('set_label')[0]
+        self.assertEqual(call.getParam(0), "2 users, on-line for 00:01:01")
+
+    def test_only_changes_redrawn(self):
+        """Check widgets are only updated when their contents change"""
+        self.display.show_connected(1, 10.1)
+        self.display.show_connected(1, 10.9)
+        self.display.show_connected(1, 11.2)
+        self.assertEqual(
+            len(self.window.details_label.getNamedCalls('set_label')), 2)
+        self.assertEqual(
+            len(self.window.status_label.getNamedCalls('set_label')), 1)
+        self.assertEqual(
+            len(self.window.root_widget.getNamedCalls('set_title')), 1)
+
+    def test_show_disconnected(self):
+        """Check display is reset when disconnected"""
+        self.display.show_connected(1, 10)
+        self.display.show_disconnected()
+        self.display.show_disconnected()
+        calls = self.window.connect_button.getNamedCalls('set_sensitive')
+        self.assertEqual([call.getParam(0) for call in calls], [False, True])
+
+
+class TimerManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gobject = landialler.gobject
+        landialler.gobject = mock.Mock({"timeout_add": 1,
+                                        "timeout_add_seconds": 2})
+        self.timers = landialler.TimerManager()
+
+    def tearDown(self):
+        landialler.gobject = self.gobject
+
+    def test_whole_seconds(self):
+        """Check timers of whole seconds can share wakeups"""
+        self.timers.add(2, lambda: True)
+        self.timers.add(0.5, lambda: True)
+        calls = landialler.gobject.getNamedCalls("timeout_add_seconds")
+        self.assertEqual(calls[0].getParam(0), 2)
+        calls = landialler.gobject.getNamedCalls("timeout_add")
+        self.assertEqual(calls[0].getParam(0), 500)
+
+    def test_suspend_and_resume(self):
+        """Check ui timers only run while their window can be seen"""
+        self.timers.add(0.5, lambda: True, ui=True)
+        self.timers.add(0.5, lambda: True)
+        self.timers.add(0.5, lambda: True, ui="dialog")
+        self.timers.set_visible(False)
+        self.assertEqual(
+            len(landialler.gobject.getNamedCalls("source_remove")), 1)
+        self.timers.add(0.5, lambda: True, ui=True)
+        self.timers.set_visible(True)
+        self.assertEqual(
+            len(landialler.gobject.getNamedCalls("timeout_add")), 5)
+
+    def test_wakeups_counted(self):
+        """Check each wakeup is counted, and finished timers removed"""
+        fired = []
+        timer_id = self.timers.add(0.5, lambda: fired.append(None))
+        call = landialler.gobject.getNamedCalls("timeout_add")[0]
+        self.assertEqual(call.getParam(1)(call.getParam(2)), False)
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.timers.wakeups, 1)
+        self.timers.remove(timer_id)
+        self.assertEqual(
+            len(landialler.gobject.getNamedCalls("source_remove")), 0)
+
+
+class FakeGlade:
+
+    def __init__(self):
+        self.built = []
+
+    def xml_new_from_buffer(self, buffer, size, root_widget):
+        self.built.append((buffer, size, root_widget))
+        return mock.Mock()
+
+
+class FakeGtk:
+
+    def __init__(self):
+        self.glade = FakeGlade()
+
+
+class GladeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gtk = landialler.gtk
+        self.gobject = landialler.gobject
+        landialler.gtk = FakeGtk()
+        landialler.gobject = mock.Mock()
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, "<glade-interface/>")
+        os.close(fd)
+        self.cache = landialler.GladeCache(self.filename)
+        self.idle_callbacks_run = 0
+
+    def tearDown(self):
+        landialler.gtk = self.gtk
+        landialler.gobject = self.gobject
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def run_idle_callbacks(self):
+        calls = landialler.gobject.getNamedCalls("idle_add")
+        for call in calls[self.idle_callbacks_run:]:
+            while call.getParam(0)():
+                pass
+        self.idle_callbacks_run = len(calls)
+
+    def test_file_read_once(self):
+        """Check the glade file is only read the first time it's needed"""
+        self.cache.get("main_window")
+        os.remove(self.filename)
+        self.cache.get("connecting_dialog")
+        self.assertEqual(landialler.gtk.glade.built, [
+            ("<glade-interface/>", 18, "main_window"),
+            ("<glade-interface/>", 18, "connecting_dialog")])
+
+    def test_preloaded_trees_used(self):
+        """Check get() returns a preloaded tree, and preloads another"""
+        self.cache.preload(["main_window", "connecting_dialog"])
+        self.assertEqual(len(landialler.gtk.glade.built), 0)
+        self.run_idle_callbacks()
+        self.assertEqual(len(landialler.gtk.glade.built), 2)
+        self.cache.get("connecting_dialog")
+        self.assertEqual(len(landialler.gtk.glade.built), 2)
+        self.run_idle_callbacks()
+        self.assertEqual(len(landialler.gtk.glade.built), 3)
+        self.cache.get("connecting_dialog")
+        self.cache.get("connecting_dialog")
+        self.assertEqual(len(landialler.gtk.glade.built), 4)
+
+
+class BaseWindow(landialler.WidgetWrapper):
+
+    def on_quit_clicked(self, *args):
+        return "base"
+
+    def on_help_clicked(self, *args):
+        return "base"
+
+
+class SubWindow(BaseWindow):
+
+    def on_help_clicked(self, *args):
+        return "sub"
+
+
+class WidgetWrapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = mock.Mock({"get_widget": "window"})
+        SubWindow.glade = mock.Mock({"get": self.xml})
+
+    def tearDown(self):
+        del SubWindow.glade
+
+    def test_handlers_connected(self):
+        """Check methods of base classes and subclasses are connected"""
+        SubWindow("window")
+        call = self.xml.getNamedCalls("signal_autoconnect")[0]
+        handlers = call.getParam(0)
+        for name in ["on_quit_clicked", "on_help_clicked",
+                     "_get_root_widget", "_connect_signals"]:
+            self.failUnless(handlers.has_key(name), name)
+        self.assertEqual(handlers["on_quit_clicked"](), "base")
+        self.assertEqual(handlers["on_help_clicked"](), "sub")
+
+    def test_handler_names_remembered(self):
+        """Check the handler names are only worked out once per class"""
+        names = SubWindow("window")._get_handler_names()
+        self.failUnless(SubWindow("window")._get_handler_names() is names)
+        self.failUnless(landialler.WidgetWrapper._handler_names[SubWindow]
+                        is names)
+        self.failIf(landialler.WidgetWrapper._handler_names.get(
+            BaseWindow) is names)
+
+
+class RpcStatsTest(unittest.TestCase):
+
+    def test_calls_recorded(self):
+        """Check modem records the time taken by each call"""
+        modem = landialler.RemoteModem(mock.Mock({'get_status': (1, True, 2)}))
+        modem.connect()
+        modem.get_status()
+        modem.get_status()
+        self.assertEqual(modem.stats.methods['connect'].calls, 1)
+        self.assertEqual(modem.stats.methods['get_status'].calls, 2)
+        self.assertEqual(sum(modem.stats.methods['get_status'].histogram), 2)
+
+    def test_errors_recorded(self):
+        """Check socket errors and timeouts are counted separately"""
+        stats = landialler.RpcStats()
+        stats.record("get_status", 0.003)
+        stats.record("get_status", 10, socket.timeout)
+        stats.record("get_status", 0.1, socket.error)
+        call_stats = stats.methods["get_status"]
+        self.assertEqual(call_stats.errors,
+                         {"timeouts": 1, "socket errors": 1})
+        self.assertEqual(call_stats.histogram[2], 1)  # <= 5ms
+        self.assertEqual(call_stats.max_time, 10)
+
+    def test_report(self):
+        """Check statistics can be reported"""
+        stats = landialler.RpcStats()
+        stats.record("connect", 0.0005)
+        self.assertEqual(stats.report(),
+                         ["connect: 1 calls, mean 0.5 ms, max 0.5 ms",
+                          "  ms <=1: 1"])
+
+
+class UnreachableServer:
+
+    def __init__(self):
+        self.calls = 0
+
+    def connect(self, client_id):
+        self.calls += 1
+        raise socket.error
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_failures(self):
+        """Check breaker stops calls after repeated failures"""
+        breaker = landialler.CircuitBreaker(max_failures=2, jitter=0)
+        breaker.failed()
+        self.assert_(breaker.allow())
+        breaker.failed()
+        self.assert_(breaker.is_open)
+        self.failIf(breaker.allow())
+
+    def test_trial_call(self):
+        """Check breaker lets one call through after reset period"""
+        breaker = landialler.CircuitBreaker(max_failures=1,
+                                            reset_period=0.05, jitter=0)
+        breaker.failed()
+        self.failIf(breaker.allow())
+        time.sleep(0.1)
+        self.assert_(breaker.allow())
+        self.failIf(breaker.allow())
+        breaker.succeeded()
+        self.failIf(breaker.is_open)
+        self.assert_(breaker.allow())
+
+    def test_modem_goes_offline(self):
+        """Check modem goes off-line rather than raising socket.error"""
+        server = UnreachableServer()
+        modem = landialler.RemoteModem(
+            server, breaker=landialler.CircuitBreaker(max_failures=2))
+        observer = mock.Mock()
+        modem.add_observer(observer)
+        for i in range(4):
+            modem.connect()
+        self.assert_(modem.is_offline)
+        self.assertEqual(server.calls, 2)
+        self.assertEqual(len(observer.getNamedCalls('update')), 1)
+
+    def test_modem_comes_back(self):
+        """Check modem comes back on-line when server responds"""
+        server = mock.Mock({'get_status': (1, True, 2)})
+        modem = landialler.RemoteModem(server,
+                                       breaker=landialler.CircuitBreaker())
+        modem.is_offline = True
+        modem.get_status()
+        self.failIf(modem.is_offline)
+
+
+class AdaptivePollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = landialler.AdaptivePollScheduler(
+            fast_period=1, slow_period=10, max_period=60, growth=2, jitter=0)
+
+    def test_fast_while_connecting(self):
+        """Check status is checked quickly while connecting"""
+        self.scheduler.connecting()
+        self.scheduler.succeeded(False)
+        self.scheduler.succeeded(False)
+        self.assertEqual(self.scheduler.next_delay(), 1)
+
+    def test_connecting_cancelled(self):
+        """Check status checks slow down if connecting is cancelled"""
+        self.scheduler.connecting()
+        self.scheduler.set_idle(True)
+        self.scheduler.succeeded(False, wants_connection=False)
+        self.assertEqual(self.scheduler.next_delay(), 8)
+
+    def test_slows_down_when_stable(self):
+        """Check status is checked less often once connected"""
+        self.scheduler.connecting()
+        delays = []
+        for i in range(5):
+            self.scheduler.succeeded(True)
+            delays.append(self.scheduler.next_delay())
+        self.assertEqual(delays, [2, 4, 8, 10, 10])
+
+    def test_backs_off_on_failure(self):
+        """Check failed status checks back off exponentially"""
+        delays = []
+        for i in range(7):
+            self.scheduler.failed()
+            delays.append(self.scheduler.next_delay())
+        self.assertEqual(delays, [2, 4, 8, 16, 32, 60, 60])
+
+    def test_user_action(self):
+        """Check status is checked quickly after user does something"""
+        for i in range(5):
+            self.scheduler.succeeded(True)
+        self.scheduler.user_action()
+        self.assertEqual(self.scheduler.next_delay(), 1)
+
+    def test_jitter(self):
+        """Check delays are randomised within the jitter range"""
+        scheduler = landialler.AdaptivePollScheduler(fast_period=10,
+                                                     jitter=0.1)
+        for i in range(20):
+            self.assert_(9 <= scheduler.next_delay() <= 11)
+
+    def test_checks_around_expected_connect_time(self):
+        """Check status is checked half way to the expected connect time"""
+        self.scheduler.connecting(eta=40)
+        self.assertEqual(self.scheduler.next_delay(), 1)
+        self.scheduler.succeeded(False)
+        self.assert_(19 <= self.scheduler.next_delay() <= 20)
+        self.scheduler.connecting(eta=1)
+        self.scheduler.succeeded(False)
+        self.assertEqual(self.scheduler.next_delay(), 1)
+
+
+class FakeModem(landialler.Observable):
+
+    def __init__(self):
+        landialler.Observable.__init__(self)
+        self.is_connected = False
+        self.wants_connection = False
+        self.num_users = 1
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        self.wants_connection = True
+
+    def hung_up(self):
+        self.wants_connection = False
+
+
+class ReconnectSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = FakeModem()
+        self.timers = mock.Mock({"add": 1})
+        self.listener = mock.Mock()
+        self.supervisor = landialler.ReconnectSupervisor(
+            self.modem, self.timers, self.listener, min_delay=5, max_delay=15)
+
+    def set_connected(self, is_connected, wants_connection=True,
+                      num_users=1):
+        self.modem.is_connected = is_connected
+        self.modem.wants_connection = wants_connection
+        self.modem.num_users = num_users
+        self.modem.notify_observers()
+
+    def test_no_drop_when_user_disconnects(self):
+        """Check disconnecting deliberately isn't treated as a drop"""
+        self.set_connected(True)
+        self.set_connected(False, wants_connection=False)
+        self.assertEqual(self.supervisor.drops, 0)
+        self.assertEqual(len(self.listener.getNamedCalls("dropped")), 0)
+
+    def test_no_drop_when_somebody_hangs_up(self):
+        """Check hanging up for everybody isn't treated as a drop"""
+        self.set_connected(True)
+        self.set_connected(False, num_users=0)
+        self.assertEqual(self.supervisor.drops, 0)
+        self.failIf(self.modem.wants_connection)
+        self.assertEqual(len(self.timers.getNamedCalls("add")), 0)
+
+    def test_redials_after_drop(self):
+        """Check a dropped connection is redialled with back off"""
+        self.set_connected(True)
+        self.set_connected(False)
+        self.assertEqual(self.supervisor.drops, 1)
+        self.assertEqual(self.listener.getNamedCalls("dropped")[0].getParam(0),
+                         True)
+        delays = []
+        for i in range(3):
+            call = self.timers.getNamedCalls("add")[-1]
+            delays.append(call.getParam(0))
+            call.getParam(1)()
+        self.assertEqual(delays, [5, 10, 15])
+        self.assertEqual(self.modem.connects, 3)
+        self.assertEqual(len(self.listener.getNamedCalls("redialling")), 3)
+
+    def test_recovery(self):
+        """Check recovering from a drop stops the redialling"""
+        self.set_connected(True)
+        self.set_connected(False)
+        self.set_connected(True)
+        self.assertEqual(self.supervisor.recoveries, 1)
+        self.assertEqual(len(self.listener.getNamedCalls("recovered")), 1)
+        self.assertEqual(len(self.timers.getNamedCalls("remove")), 1)
+        self.set_connected(False)
+        self.assertEqual(self.supervisor.drops, 2)
+
+    def test_no_redial(self):
+        """Check redialling can be turned off"""
+        supervisor = landialler.ReconnectSupervisor(
+            self.modem, mock.Mock(), self.listener, redial=False)
+        self.set_connected(True)
+        self.set_connected(False)
+        self.assertEqual(supervisor.drops, 1)
+        self.assertEqual(self.modem.connects, 0)
+
+    def test_report(self):
+        """Check the report describes the drops"""
+        self.set_connected(True)
+        self.set_connected(False)
+        self.set_connected(True)
+        report = self.supervisor.report()
+        self.assertEqual(report[0], "connection drops: 1, recovered: 1")
+        self.assert_(report[1].startswith("mean time to recover: "))
+
+
+class ManualWorker(object):
+
+    """An RpcWorker that only makes calls when told to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def call(self, func, args, callback, errback):
+        call = landialler.RpcCall(func, args, callback, errback)
+        self.calls.append(call)
+        return call
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for call in calls:
+            if call.start():
+                try:
+                    result = call.func(*call.args)
+                except:
+                    call.errback(sys.exc_info())
+                else:
+                    call.callback(result)
+
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock.Mock({"get_status": (1, True, 10)})
+        self.worker = ManualWorker()
+        self.modem = landialler.RemoteModem(self.server, self.worker,
+                                            client_id="test")
+
+    def test_status_checks_shared(self):
+        """Check status isn't requested again while a request is pending"""
+        errors = []
+        self.modem.connect()
+        self.worker.run()
+        self.modem.get_status()
+        self.modem.get_status(errors.append)
+        self.assertEqual(len(self.worker.calls), 1)
+        self.worker.run()
+        self.assertEqual(len(self.server.getNamedCalls("get_status")), 1)
+        self.assertEqual(self.modem.calls_shared, 1)
+        self.assertEqual(self.modem.is_connected, True)
+        self.modem.get_status()
+        self.assertEqual(len(self.worker.calls), 1)
+
+    def test_errors_shared(self):
+        """Check every caller sharing a failed request is told about it"""
+        def fail(client_id):
+            raise socket.error
+        self.server.get_status = fail
+        errors = []
+        self.modem.connect()
+        self.worker.run()
+        self.modem.get_status(errors.append)
+        self.modem.get_status(errors.append)
+        self.worker.run()
+        self.assertEqual(len(errors), 2)
+
+    def test_repeated_connects(self):
+        """Check connecting repeatedly only sends one request"""
+        for i in range(5):
+            self.modem.connect()
+        self.assertEqual(len(self.worker.calls), 1)
+
+    def test_connect_then_disconnect(self):
+        """Check nothing is sent if we disconnect before connecting"""
+        self.modem.connect()
+        self.modem.disconnect()
+        self.worker.run()
+        self.assertEqual(len(self.server.getNamedCalls("connect")), 0)
+        self.assertEqual(len(self.server.getNamedCalls("disconnect")), 0)
+        self.assertEqual(self.modem.calls_avoided, 2)
+
+    def test_disconnect_after_connect_sent(self):
+        """Check disconnect is sent if the server has seen the connect"""
+        self.modem.connect()
+        self.worker.run()
+        self.modem.connect()
+        self.modem.disconnect()
+        self.worker.run()
+        self.assertEqual(len(self.server.getNamedCalls("connect")), 1)
+        self.assertEqual(len(self.server.getNamedCalls("disconnect")), 1)
+
+    def test_hang_up_always_sent(self):
+        """Check hanging up for everyone is always sent"""
+        self.modem.connect()
+        self.modem.disconnect(all=True)
+        self.worker.run()
+        self.assertEqual(len(self.server.getNamedCalls("disconnect")), 1)
+
+
+class LocalStatusFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "status")
+        self.feeds = []
+
+    def tearDown(self):
+        for feed in self.feeds:
+            feed.stop()
+        shutil.rmtree(self.directory)
+
+    def start_feed(self, server, subscription=None):
+        modem = landialler.RemoteModem(server, client_id="test")
+        feed = landialler.LocalStatusFeed(self.path, modem, dispatch_now,
+                                          subscription)
+        modem.status_feed = feed
+        feed.start()
+        self.feeds.append(feed)
+        return modem, feed
+
+    def test_status_shared(self):
+        """Check clients on the same host share the publisher's status"""
+        if not landialler.LocalStatusFeed.is_supported():
+            return
+        server = mock.Mock({"get_status": (2, True, 30)})
+        publisher, publisher_feed = self.start_feed(server)
+        self.assert_(wait_until(lambda: publisher_feed.is_publishing))
+        subscriber, subscriber_feed = self.start_feed(mock.Mock())
+        self.assert_(wait_until(lambda: publisher_feed.has_subscribers))
+        self.assertEqual(subscriber_feed.is_publishing, False)
+        subscriber._checking_status = True
+        publisher.get_status()
+        self.assert_(wait_until(lambda: subscriber.is_connected))
+        self.assertEqual(subscriber.num_users, 2)
+        self.assertEqual(subscriber.is_subscribed, True)
+        subscriber.get_status()
+        time.sleep(0.1)
+        self.assertEqual(len(server.getNamedCalls("get_status")), 1)
+
+    def test_take_over_publishing(self):
+        """Check a subscriber publishes once the publisher has gone"""
+        if not landialler.LocalStatusFeed.is_supported():
+            return
+        publisher, publisher_feed = self.start_feed(mock.Mock())
+        self.assert_(wait_until(lambda: publisher_feed.is_publishing))
+        subscriber, subscriber_feed = self.start_feed(mock.Mock())
+        self.assert_(wait_until(lambda: publisher_feed.has_subscribers))
+        publisher_feed.stop()
+        self.assert_(wait_until(lambda: subscriber_feed.is_publishing))
+
+    def test_stalled_subscriber(self):
+        """Check a subscriber that doesn't read can't hold up publishing"""
+        if not landialler.LocalStatusFeed.is_supported():
+            return
+        publisher, feed = self.start_feed(mock.Mock())
+        self.assert_(wait_until(lambda: feed.is_publishing))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.assert_(wait_until(lambda: feed.has_subscribers))
+        def publish():
+            for i in range(100000):
+                feed.publish((1, True, i))
+        thread = threading.Thread(target=publish)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(5)
+        sock.close()
+        self.failIf(thread.isAlive())
+        self.failIf(feed.has_subscribers)
+
+    def test_insecure_directory(self):
+        """Check the status isn't shared if anybody could publish it"""
+        if not landialler.LocalStatusFeed.is_supported():
+            return
+        os.chmod(self.directory, 0777)
+        subscription = mock.Mock()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            modem, feed = self.start_feed(mock.Mock(), subscription)
+            self.assert_(wait_until(
+                lambda: subscription.getNamedCalls("start")))
+            self.assert_(sys.stderr.getvalue().startswith(
+                "landialler: not sharing the status"))
+        finally:
+            sys.stderr = stderr
+        self.failIf(feed.is_publishing)
+        self.failIf(os.path.exists(self.path))
+
+    def test_gives_up(self):
+        """Check the feed stops trying if it can't publish"""
+        if not landialler.LocalStatusFeed.is_supported():
+            return
+        self.path = os.path.join(self.directory, "missing", "status")
+        subscription = mock.Mock()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            modem = landialler.RemoteModem(mock.Mock(), client_id="test")
+            feed = landialler.LocalStatusFeed(self.path, modem, dispatch_now,
+                                              subscription)
+            feed.RETRY_PERIOD = 10  # the missing directory isn't retried
+            feed.start()
+            self.feeds.append(feed)
+            self.assert_(wait_until(
+                lambda: subscription.getNamedCalls("start")))
+            self.assertEqual(sys.stderr.getvalue().count("\n"), 1)
+        finally:
+            sys.stderr = stderr
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakelandiallerd.Server(
+            ("127.0.0.1", 0), fakelandiallerd.FakeModem(dial_time=0.1))
+        self.server.start()
+        url = "http://127.0.0.1:%s/" % self.server.server_address[1]
+        self.output = StringIO.StringIO()
+        self.transport = landialler.KeepAliveTransport()
+        self.command = landialler.CommandLine(
+            landialler.RemoteModem(xmlrpclib.ServerProxy(url, self.transport)),
+            landialler.PollScheduler(0.05), self.output)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_status(self):
+        """Check status command reports that we're disconnected"""
+        self.assertEqual(self.command.status(), self.command.NOT_CONNECTED)
+        self.assertEqual(self.output.getvalue(), "disconnected\n")
+
+    def test_connect_and_wait(self):
+        """Check connect command can wait until we're connected"""
+        self.assertEqual(self.command.connect(wait=True, timeout=5),
+                         self.command.OK)
+        self.assert_(self.output.getvalue().startswith("connected (users: 1"))
+        self.assertEqual(self.command.status(), self.command.OK)
+
+    def test_wait_times_out(self):
+        """Check connect command gives up waiting after the timeout"""
+        self.server.modem.dial_time = 10
+        self.assertEqual(self.command.connect(wait=True, timeout=0.2),
+                         self.command.NOT_CONNECTED)
+
+    def test_disconnect(self):
+        """Check disconnect command unregisters us"""
+        self.command.connect(wait=True, timeout=5)
+        self.assertEqual(self.command.disconnect(), self.command.OK)
+        self.assertEqual(self.server.modem.get_status("x"), (0, False, 0))
+
+    def test_no_gtk(self):
+        """Check GTK isn't imported until the GUI needs it"""
+        self.assertEqual(landialler.gtk, None)
+
+
+class StartupProfilerTest(unittest.TestCase):
+
+    def test_report(self):
+        """Check profiler reports each phase and the total"""
+        profiler = landialler.StartupProfiler()
+        profiler.mark("config")
+        profiler.mark("imports")
+        report = profiler.report()
+        self.assertEqual([phase for phase, seconds in profiler.phases],
+                         ["config", "imports"])
+        self.assertEqual(len(report), 3)
+        self.assert_(report[0].startswith("config:"))
+        self.assert_(report[2].startswith("total:"))
+
+    def test_module_imports_timed(self):
+        """Check the first phase includes importing the modules"""
+        app = landialler.App([])
+        phase, seconds = app._profiler.phases[0]
+        self.assertEqual(phase, "modules")
+        self.assertEqual(app._profiler.started, landialler._IMPORTS_STARTED)
+
+    def test_failed_first_call_reported(self):
+        """Check startup is reported even if the server can't be reached"""
+        app = landialler.App([])
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            app._first_reply_failed((socket.error, socket.error(), None))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assert_("failed RPC:" in output)
+        self.assert_("total:" in output)
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class FailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.hosts = []
+        self.transports = []
+        for i in range(2):
+            server = fakelandiallerd.Server(("127.0.0.1", 0))
+            server.start()
+            self.servers.append(server)
+            self.hosts.append("127.0.0.1:%s" % server.server_address[1])
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def make_proxy(self, hosts):
+        endpoints = []
+        for host in hosts:
+            self.transports.append(landialler.KeepAliveTransport(5))
+            endpoints.append(landialler.Endpoint(host, self.transports[-1]))
+        return landialler.FailoverServerProxy(endpoints, 5)
+
+    def test_dead_server_skipped(self):
+        """Check the first server that answers is used"""
+        proxy = self.make_proxy(["127.0.0.1:%s" % unused_port(),
+                                 self.hosts[0]])
+        self.assertEqual(tuple(proxy.get_status("a")), (0, False, 0))
+        self.assertEqual(proxy.current.host, self.hosts[0])
+        self.assertEqual(proxy.current.transport.connections_opened, 1)
+
+    def test_no_servers(self):
+        """Check an error is raised if no server can be contacted"""
+        proxy = self.make_proxy(["127.0.0.1:%s" % unused_port(),
+                                 "127.0.0.1:%s" % unused_port()])
+        self.assertRaises(socket.error, proxy.get_status, "a")
+
+    def test_failover(self):
+        """Check calls go to another server if the current one fails"""
+        proxy = self.make_proxy(self.hosts)
+        self.assert_("system.multicall" in proxy.system.listMethods())
+        first = proxy.current
+        index = self.hosts.index(first.host)
+        self.servers[index].shutdown()
+        self.servers[index].server_close()
+        del self.servers[index]
+        first.transport.close()
+        self.assertEqual(tuple(proxy.get_status("a")), (0, False, 0))
+        self.assertNotEqual(proxy.current, first)
+        self.assertEqual(proxy.failovers, 1)
+
+    def test_address_cache(self):
+        """Check addresses are only looked up once"""
+        cache = landialler.AddressCache()
+        addresses = cache.resolve(self.hosts[0])
+        self.assertEqual(cache.resolve(self.hosts[0]), addresses)
+        self.assertEqual(cache.lookups, 1)
+
+
+class WebPageHandler(KeepAliveHandler):
+
+    def do_GET(self):
+        body = "<html><body>Not a status frame</body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CompactStatusTest(unittest.TestCase):
+
+    def start_server(self, status_frames):
+        self.server = fakelandiallerd.Server(
+            ("127.0.0.1", 0), fakelandiallerd.FakeModem(dial_time=0),
+            status_frames=status_frames)
+        self.server.start()
+        host = "127.0.0.1:%s" % self.server.server_address[1]
+        self.transport = landialler.KeepAliveTransport()
+        self.proxy = landialler.CompactStatusProxy(
+            xmlrpclib.ServerProxy("http://%s/" % host, self.transport), host,
+            self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_status_frame(self):
+        """Check status is fetched as a binary frame if supported"""
+        self.start_server(True)
+        self.proxy.connect("a@b")
+        self.assert_(wait_until(lambda: self.proxy.get_status("a@b")[1]))
+        self.assertEqual(self.proxy.get_status("a@b")[:2], (1, True))
+        self.assertEqual(self.proxy.is_supported, True)
+        self.assertEqual(self.transport.connections_opened, 1)
+
+    def test_fall_back_to_xmlrpc(self):
+        """Check status is fetched over XML-RPC from older servers"""
+        self.start_server(False)
+        self.assertEqual(self.proxy.get_status("a@b"), [0, False, 0])
+        self.assertEqual(self.proxy.is_supported, False)
+        calls = self.transport.calls_made
+        self.proxy.get_status("a@b")
+        self.assertEqual(self.transport.calls_made, calls + 1)
+
+    def test_failure(self):
+        """Check a failed status frame request isn't taken as unsupported"""
+        self.start_server(True)
+        self.server.failure_rate = 1
+        self.assertRaises(xmlrpclib.ProtocolError, self.proxy.get_status, "a")
+        self.assertEqual(self.proxy.is_supported, None)
+
+    def test_not_a_status_frame(self):
+        """Check status is fetched over XML-RPC if a GET returns a page"""
+        self.server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ("127.0.0.1", 0), WebPageHandler, logRequests=False)
+        self.server.register_function(lambda client_id: (0, False, 0),
+                                      "get_status")
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        host = "127.0.0.1:%s" % self.server.server_address[1]
+        self.transport = landialler.KeepAliveTransport()
+        self.proxy = landialler.CompactStatusProxy(
+            xmlrpclib.ServerProxy("http://%s/" % host, self.transport), host,
+            self.transport)
+        self.assertEqual(self.proxy.get_status("a@b"), [0, False, 0])
+        self.assertEqual(self.proxy.is_supported, False)
+
+
+class StatusHistoryTest(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        """Check history keeps a fixed number of the latest samples"""
+        history = landialler.StatusHistory(capacity=3)
+        for i in range(5):
+            history.add(i, i, True)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.samples(),
+                         [(2, 2, True), (3, 3, True), (4, 4, True)])
+
+    def test_samples_since(self):
+        """Check samples since a time include the status at that time"""
+        history = landialler.StatusHistory(capacity=10)
+        for i in range(5):
+            history.add(i * 10, i, i % 2 == 1)
+        self.assertEqual(history.samples(25), [(20, 2, False),
+                                               (30, 3, True),
+                                               (40, 4, False)])
+        self.assertEqual(history.peak_users(25), 4)
+
+    def test_records_changes(self):
+        """Check a sample is taken when the modem's status changes"""
+        modem = landialler.RemoteModem(mock.Mock())
+        history = landialler.StatusHistory(modem)
+        modem.connect()
+        modem.status_pushed((3, True, 0))
+        modem.status_pushed((3, True, 1))
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history.samples()[0][1:], (3, True))
+
+    def test_graph(self):
+        """Check the graph shows sessions and numbers of users"""
+        samples = [(0, 0, False), (50, 2, True), (75, 1, True)]
+        sessions, points = landialler.history_graph(samples, 100, 100,
+                                                    101, 11)
+        self.assertEqual(sessions, [(50, 100)])
+        self.assertEqual(points, [(0, 10), (50, 10), (50, 0), (75, 0),
+                                  (75, 5), (100, 5)])
+
+
+class HistoryLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "/tmp/landialler-history-test-%d" % os.getpid()
+
+    def tearDown(self):
+        for path in [self.path, self.path + ".1", self.path + ".2"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_written_in_batches(self):
+        """Check samples are only written when the log is flushed"""
+        log = landialler.HistoryLog(self.path)
+        history = landialler.StatusHistory(log=log)
+        history.add(100, 2, True)
+        self.failIf(os.path.exists(self.path))
+        log.flush()
+        history = landialler.StatusHistory(log=landialler.HistoryLog(
+            self.path))
+        self.assertEqual(history.samples(), [(100, 2, True)])
+
+    def test_rotation(self):
+        """Check the log is rotated when it gets too big"""
+        log = landialler.HistoryLog(self.path, max_bytes=20, backups=1)
+        for i in range(6):
+            log.write(1000 + i, 1, True)
+            log.flush()
+        self.assert_(os.path.getsize(self.path) <= 20)
+        self.assert_(os.path.exists(self.path + ".1"))
+        self.failIf(os.path.exists(self.path + ".2"))
+        self.assertEqual(log.read()[-1], (1005, 1, True))
+
+
+class ConnectTimeEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "/tmp/landialler-connect-times-test-%d" % os.getpid()
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_median(self):
+        """Check the estimate is the median of recent connect times"""
+        estimator = landialler.ConnectTimeEstimator(max_samples=3)
+        self.assertEqual(estimator.estimate(), None)
+        for seconds in [100, 20, 30, 25]:
+            estimator.add(seconds)
+        self.assertEqual(estimator.estimate(), 25)
+
+    def test_only_records_dialling(self):
+        """Check connects that didn't need to dial aren't recorded"""
+        estimator = landialler.ConnectTimeEstimator()
+        estimator.connecting()
+        estimator.status_checked(True)
+        self.assertEqual(estimator.times, [])
+        estimator.connecting()
+        estimator.status_checked(False)
+        estimator.cancelled()
+        estimator.status_checked(True)
+        self.assertEqual(estimator.times, [])
+        estimator.connecting()
+        estimator.status_checked(False)
+        estimator.status_checked(True)
+        self.assertEqual(len(estimator.times), 1)
+
+    def test_saved(self):
+        """Check connect times are saved between runs"""
+        landialler.ConnectTimeEstimator(self.path).add(30)
+        estimator = landialler.ConnectTimeEstimator(self.path)
+        self.assertEqual(estimator.estimate(), 30)
+
+    def test_progress(self):
+        """Check how far through connecting we appear to be"""
+        self.assertEqual(landialler.connect_progress(10, 40),
+                         (0.25, "About 30 seconds left"))
+        self.assertEqual(landialler.connect_progress(50, 40)[0], None)
+        self.assertEqual(landialler.connect_progress(10, None)[0], None)
+
+
+class OnlineClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.wall_time = 5000.0
+        self.clock = landialler.OnlineClock(
+            max_drift=2, clock=lambda: self.now,
+            wall_clock=lambda: self.wall_time)
+
+    def wait(self, seconds):
+        self.now += seconds
+        self.wall_time += seconds
+
+    def test_latency_compensation(self):
+        """Check the server's time is taken from half way through a call"""
+        self.clock.sync(100, sent=self.now - 4, received=self.now)
+        self.assertEqual(self.clock.seconds(), 102)
+
+    def test_only_resyncs_on_drift(self):
+        """Check the clock is only set again if it drifts too far"""
+        self.clock.sync(100)
+        self.wait(10)
+        self.failIf(self.clock.sync(111))
+        self.assertEqual(self.clock.seconds(), 110)
+        self.failUnless(self.clock.sync(3))
+        self.assertEqual(self.clock.seconds(), 3)
+        self.assertEqual(self.clock.resyncs, 1)
+
+    def test_ignores_system_time_changes(self):
+        """Check setting the system time doesn't affect the clock"""
+        self.clock.sync(100)
+        self.wall_time -= 3600
+        self.wait(5)
+        self.assertEqual(self.clock.seconds(), 105)
+
+    def test_stale_after_suspend(self):
+        """Check the clock needs setting after being suspended"""
+        self.clock.sync(100)
+        self.wait(5)
+        self.failIf(self.clock.is_stale())
+        self.wall_time += 600  # the monotonic clock stopped
+        self.failUnless(self.clock.is_stale())
+        self.clock.sync(705)
+        self.failIf(self.clock.is_stale())
+        self.assertEqual(self.clock.seconds(), 705)
+
+    def test_monotonic(self):
+        """Check the monotonic clock doesn't go backwards"""
+        before = landialler.monotonic()
+        self.failIf(landialler.monotonic() < before)
+
+
+class ConfigTest(unittest.TestCase):
+
+    def make_app(self, text):
+        app = landialler.App([])
+        app._config = ConfigParser.ConfigParser()
+        app._config.readfp(StringIO.StringIO(text))
+        return app
+
+    def test_policy_options(self):
+        """Check a policy is only given the options that it accepts"""
+        app = self.make_app("[polling]\npolicy: Fixed\n"
+                            "fast_period: 0.5\nidle_factor: 4\n")
+        scheduler = app._create_scheduler()
+        self.assertEqual(scheduler.__class__, landialler.PollScheduler)
+        app = self.make_app("[polling]\npolicy: adaptive\nperiod: 5\n"
+                            "idle_factor: 2\n")
+        self.assertEqual(app._create_scheduler().idle_factor, 2)
+
+    def test_mistakes(self):
+        """Check mistakes in the configuration are reported clearly"""
+        for text in ["[polling]\npolicy: sometimes\n",
+                     "[polling]\nfast_perod: 1\n",
+                     "[polling]\nfast_period: soon\n",
+                     "[reconnect]\nredial: perhaps\n",
+                     "[reconnect]\nmax_wait: 10\n"]:
+            app = self.make_app(text)
+            self.assertRaises(landialler.ConfigError, app._check_config)
+
+
 if __name__ == '__main__':
     unittest.main()